@@ -0,0 +1,63 @@
+"""
+Benchmark da classificação de mensagens por palavra-chave.
+
+Compara a busca antiga (uma varredura do texto por palavra-chave, parando na primeira)
+com o ClassificadorEmergencias (uma única passada que encontra todas as categorias).
+
+Uso: python benchmarks/bench_classificador.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+
+TRECHOS = [
+    "Bom dia, aqui é da secretaria da escola.",
+    "Tem um aluno passando mal no pátio, precisamos de ajuda.",
+    "AGRESSOR ARMADO no bloco B, alunos trancados nas salas!",
+    "Há um homem com uma faca no portão, SOCORRO",
+    "Encontramos um pacote suspeito, possível bomba perto da quadra.",
+    "Professora feita refém na sala 12, o agressor está com ela.",
+    "Isto é apenas um teste do sistema, desconsiderar.",
+    "Houve tentativa de homicídio na saída, vítima consciente.",
+    "Obrigado pelo atendimento de ontem.",
+    "Qual o telefone do batalhão da região?",
+]
+
+
+def gerar_corpus(quantidade):
+    return [" ".join(random.choices(TRECHOS, k=random.randint(1, 4))) for _ in range(quantidade)]
+
+
+def classificar_antigo(texto):
+    texto_normalizado = guardiao_bot.normalizar_texto.__wrapped__(texto)
+    for palavra in ["AGRESSOR", "HOMICIDIO", "REFEM", "BOMBA", "SOCORRO", "TESTE"]:
+        if palavra in texto_normalizado:
+            return palavra
+    return None
+
+
+def classificar_novo_sem_cache(texto):
+    guardiao_bot.normalizar_texto.cache_clear()
+    return guardiao_bot.classificador.classificar(texto)
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    corpus = gerar_corpus(20_000)
+    classificador = guardiao_bot.classificador
+
+    multiplas = sum(1 for texto in corpus if len(classificador.classificar(texto)) > 1)
+    print(f"Corpus: {len(corpus)} mensagens, {multiplas} com mais de uma categoria")
+
+    for nome, funcao in (
+        ("antigo (primeira palavra)", classificar_antigo),
+        ("novo sem memoização", classificar_novo_sem_cache),
+        ("novo com memoização", classificador.classificar),
+    ):
+        tempo = timeit.timeit(lambda: [funcao(texto) for texto in corpus], number=3) / 3
+        print(f"{nome:<28} {tempo / len(corpus) * 1e6:7.2f} µs/mensagem")
@@ -0,0 +1,82 @@
+"""
+Benchmark das consultas ao histórico de incidentes.
+
+Gera um histórico sintético (aberto, atualizações, ciente e encerrado para cada
+incidente) e mede as consultas do /historico por escola, por período e a exportação
+em CSV, que usam os índices do SQLite em vez de carregar o log em memória, e o
+fechamento dos incidentes pendentes feito no boot.
+
+Uso: python benchmarks/bench_historico.py [incidentes]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+DIRETORIO_TEMPORARIO = tempfile.mkdtemp(prefix="guardiao_historico_")
+os.environ.setdefault("ARQUIVO_HISTORICO", os.path.join(DIRETORIO_TEMPORARIO, "historico.sqlite3"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+
+ESCOLAS = 2000
+TIPOS = ["agressor", "bomba", "refém", "homicídio", "teste"]
+UM_ANO = 365 * 86400
+
+
+def gerar_eventos(incidentes, agora):
+    for i in range(incidentes):
+        chave = random.getrandbits(62)
+        escola = f"Escola Estadual {i % ESCOLAS:04d}"
+        aberto = agora - random.uniform(0, UM_ANO)
+        escola = (guardiao_bot.normalizar_chave(escola), escola, f"Região {i % 40}", random.choice(TIPOS))
+        vazio = (None, None, None, None)
+        yield (chave, "aberto", aberto, *escola, f"servidor{i}", "AGRESSOR no bloco B")
+        for j in range(random.randint(0, 3)):
+            yield (chave, "atualizacao", aberto + 30 * (j + 1), *vazio, None, "mais detalhes")
+        yield (chave, "reconhecido", aberto + 60, *vazio, "Central", None)
+        yield (chave, "encerrado", aberto + 900, *vazio, "Central", None)
+
+
+def medir(nome, funcao, repeticoes=20):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = funcao()
+    print(f"{nome:<42} {(time.perf_counter() - inicio) / repeticoes * 1000:8.2f} ms")
+    return resultado
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    incidentes = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+    historico = guardiao_bot.historico_incidentes
+    agora = time.time()
+
+    inicio = time.perf_counter()
+    lote = []
+    for evento in gerar_eventos(incidentes, agora):
+        lote.append(evento)
+        if len(lote) >= 50_000:
+            historico._gravar(lote)
+            lote = []
+    historico._gravar(lote)
+    tamanho = os.path.getsize(historico.caminho) / 1024 / 1024
+    print(
+        f"{incidentes} incidentes, {historico.eventos_gravados} eventos gravados em "
+        f"{time.perf_counter() - inicio:.1f} s ({tamanho:.0f} MB)"
+    )
+
+    escola = guardiao_bot.normalizar_chave("Escola Estadual 0042")
+    semana = guardiao_bot.interpretar_periodo("7d", agora)
+    marco = guardiao_bot.interpretar_periodo("01/03-31/03", agora)
+    medir("/historico <escola> (20 mais recentes)", lambda: list(historico.consultar(escola, limite=20)))
+    medir("/historico <escola> (contagem)", lambda: historico.contar(escola))
+    medir("/historico 7d (20 mais recentes)", lambda: list(historico.consultar(None, *semana, limite=20)))
+    medir("/historico 7d (contagem)", lambda: historico.contar(None, *semana))
+    medir("/historico <escola> 01/03-31/03", lambda: list(historico.consultar(escola, *marco, limite=20)))
+    medir("/historico escola estadual 00 (prefixo)", lambda: list(historico.consultar("ESCOLA ESTADUAL 00", limite=20)))
+    conteudo = medir("/historico <escola> csv", lambda: historico.exportar_csv(escola), repeticoes=5)
+    linhas = conteudo.decode("utf-8-sig").splitlines()
+    print(f"CSV da escola: {len(linhas) - 1} incidentes, {len(conteudo) / 1024:.0f} KB")
+    medir("boot: encerrar incidentes pendentes", lambda: historico.encerrar_pendentes("reinício do bot"), repeticoes=1)
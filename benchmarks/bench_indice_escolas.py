@@ -0,0 +1,61 @@
+"""
+Micro-benchmark da busca de cadastro por Chat ID.
+
+Compara a varredura linear antiga (lista de dicts + str() em cada linha)
+com o IndiceEscolas, para planilhas de 10 mil a 100 mil linhas.
+
+Uso: python benchmarks/bench_indice_escolas.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+
+
+def gerar_linhas(quantidade):
+    return [
+        {
+            'Chat ID': str(100000000 + i),
+            'Escola': f"Escola Estadual {i // 5}",
+            'Região': f"Região {i % 40}",
+            'Nome': f"Servidor {i}",
+            'Função': "Diretor",
+            'Telefone': "(61) 99999-0000",
+            'Email': f"servidor{i}@escola.df.gov.br",
+            'Endereço': f"Quadra {i % 300}",
+            'Localização': "-15.79,-47.88",
+        }
+        for i in range(quantidade)
+    ]
+
+
+def busca_linear(linhas, chat_id):
+    for linha in linhas:
+        if str(linha['Chat ID']) == str(chat_id):
+            return linha
+    return None
+
+
+def medir(quantidade, repeticoes=2000):
+    linhas = gerar_linhas(quantidade)
+    indice = guardiao_bot.IndiceEscolas(linhas)
+    alvos = [random.randrange(quantidade) + 100000000 for _ in range(repeticoes)]
+
+    t_linear = timeit.timeit(lambda: [busca_linear(linhas, a) for a in alvos[:50]], number=1) / 50
+    t_indice = timeit.timeit(lambda: [indice.buscar(a) for a in alvos], number=1) / repeticoes
+    t_montagem = timeit.timeit(lambda: guardiao_bot.IndiceEscolas(linhas), number=1)
+
+    print(
+        f"{quantidade:>7} linhas | linear: {t_linear * 1e6:10.1f} µs/busca"
+        f" | índice: {t_indice * 1e6:6.2f} µs/busca | montagem: {t_montagem * 1e3:7.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    for n in (10_000, 25_000, 50_000, 100_000):
+        medir(n)
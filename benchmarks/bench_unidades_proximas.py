@@ -0,0 +1,78 @@
+"""
+Benchmark da busca das unidades de resposta mais próximas de uma escola.
+
+Compara a varredura de todas as unidades (haversine em cada uma) com a
+GradeEspacial usada pelo RegistroUnidades, para 1 mil a 50 mil unidades
+espalhadas pelo Distrito Federal, e confere que as duas dão o mesmo resultado.
+Mede também o caso esparso: poucas unidades concentradas em Brasília e escolas
+a milhares de quilômetros, com e sem RAIO_MAXIMO_UNIDADES_KM.
+
+Uso: python benchmarks/bench_unidades_proximas.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+
+# Retângulo aproximado do Distrito Federal
+LATITUDES = (-16.05, -15.50)
+LONGITUDES = (-48.28, -47.31)
+K = guardiao_bot.UNIDADES_MAIS_PROXIMAS
+RAIO = guardiao_bot.RAIO_MAXIMO_UNIDADES_KM
+CIDADES_DISTANTES = {"Manaus": (-3.10, -60.02), "Porto Alegre": (-30.03, -51.23), "Boa Vista": (2.82, -60.67)}
+
+
+def ponto():
+    return random.uniform(*LATITUDES), random.uniform(*LONGITUDES)
+
+
+def varredura(unidades, origem, k, raio_km=None):
+    distancias = sorted((guardiao_bot.distancia_km(origem, posicao), chat_id) for chat_id, posicao in unidades.items())[:k]
+    return [(distancia, chat_id) for distancia, chat_id in distancias if not raio_km or distancia <= raio_km]
+
+
+def medir(quantidade, consultas=200):
+    unidades = {str(i): ponto() for i in range(quantidade)}
+    grade = guardiao_bot.GradeEspacial()
+    for chat_id, (lat, lon) in unidades.items():
+        grade.mover(chat_id, lat, lon)
+    escolas = [ponto() for _ in range(consultas)]
+
+    for origem in escolas[:20]:
+        esperado = [chat_id for _, chat_id in varredura(unidades, origem, K)]
+        assert [chat_id for _, chat_id in grade.mais_proximos(origem, K)] == esperado
+        esperado = [chat_id for _, chat_id in varredura(unidades, origem, K, RAIO)]
+        assert [chat_id for _, chat_id in grade.mais_proximos(origem, K, RAIO)] == esperado
+
+    t_varredura = timeit.timeit(lambda: [varredura(unidades, e, K) for e in escolas[:20]], number=1) / 20
+    t_grade = timeit.timeit(lambda: [grade.mais_proximos(e, K) for e in escolas], number=1) / consultas
+    t_mover = timeit.timeit(lambda: grade.mover("0", *ponto()), number=10_000) / 10_000
+    print(
+        f"{quantidade:>6} unidades | varredura: {t_varredura * 1e3:8.2f} ms/alerta"
+        f" | grade: {t_grade * 1e6:7.1f} µs/alerta | atualizar posição: {t_mover * 1e6:4.1f} µs"
+    )
+
+
+def medir_esparso(quantidade=6, consultas=200):
+    unidades = {str(i): (random.uniform(-15.85, -15.75), random.uniform(-47.95, -47.85)) for i in range(quantidade)}
+    grade = guardiao_bot.GradeEspacial()
+    for chat_id, (lat, lon) in unidades.items():
+        grade.mover(chat_id, lat, lon)
+    for cidade, origem in CIDADES_DISTANTES.items():
+        for raio_km in (None, RAIO):
+            esperado = [chat_id for _, chat_id in varredura(unidades, origem, K, raio_km)]
+            assert [chat_id for _, chat_id in grade.mais_proximos(origem, K, raio_km)] == esperado
+            t_grade = timeit.timeit(lambda: grade.mais_proximos(origem, K, raio_km), number=consultas) / consultas
+            limite = f"raio {raio_km:.0f} km" if raio_km else "sem raio"
+            print(f"{quantidade} unidades em Brasília, escola em {cidade:<12} ({limite:>11}): {t_grade * 1e6:7.1f} µs/alerta, {len(esperado)} acionadas")
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    for n in (1_000, 5_000, 20_000, 50_000):
+        medir(n)
+    medir_esparso()
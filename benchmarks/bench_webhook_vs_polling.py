@@ -0,0 +1,71 @@
+"""
+Compara a latência update -> resposta do bot nos modos polling e webhook.
+
+Sobe a Bot API falsa (falsa_api_telegram.py), inicia o bot real em cada modo e mede o
+tempo entre a entrega de um /start e a chegada do sendMessage de resposta.
+
+Uso: python benchmarks/bench_webhook_vs_polling.py [quantidade]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+from falsa_api_telegram import FalsaApiTelegram  # noqa: E402
+
+TOKEN = "123:falso"
+PORTA_WEBHOOK = 8911
+SEGREDO = "segredo-local"
+
+
+async def medir(modo, quantidade):
+    api = await FalsaApiTelegram().iniciar()
+    application = guardiao_bot.criar_aplicacao(TOKEN, base_url=api.url)
+    await application.initialize()
+
+    runner = None
+    if modo == "webhook":
+        runner = await guardiao_bot.iniciar_servidor_webhook(
+            application, "127.0.0.1", PORTA_WEBHOOK, "/telegram", SEGREDO
+        )
+        await application.bot.set_webhook(f"http://127.0.0.1:{PORTA_WEBHOOK}/telegram", secret_token=SEGREDO)
+    else:
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+    await application.start()
+
+    latencias = []
+    try:
+        for i in range(quantidade):
+            chat_id = str(500000 + i)
+            inicio = time.monotonic()
+            await api.enviar_update(chat_id, "/start")
+            chegada = await api.aguardar_envio(lambda metodo, chat, _: metodo == "sendMessage" and chat == chat_id)
+            latencias.append((chegada - inicio) * 1000)
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        if runner:
+            await runner.cleanup()
+        await application.shutdown()
+        await api.parar()
+
+    latencias.sort()
+    p95 = latencias[int(len(latencias) * 0.95) - 1]
+    print(
+        f"{modo:<8} n={quantidade} | p50: {statistics.median(latencias):6.2f} ms"
+        f" | p95: {p95:6.2f} ms | máx: {latencias[-1]:6.2f} ms"
+    )
+
+
+async def main(quantidade):
+    for modo in ("polling", "webhook"):
+        await medir(modo, quantidade)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
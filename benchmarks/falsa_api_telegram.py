@@ -0,0 +1,191 @@
+"""
+Bot API do Telegram falsa, servida localmente com aiohttp.
+
+Usada pelos benchmarks para rodar o bot de verdade (python-telegram-bot apontando
+para TELEGRAM_API_URL) sem acessar a internet. Responde getMe, getUpdates,
+setWebhook/deleteWebhook e os métodos de envio, registrando cada envio com o horário
+em que chegou. Latência, respostas 429 e falhas podem ser configuradas.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+METODOS_DE_ENVIO = {
+    "sendMessage", "sendAudio", "sendVoice", "sendPhoto", "sendLocation", "sendDocument",
+    "copyMessage", "forwardMessage", "editMessageText", "editMessageLiveLocation",
+}
+
+
+class FalsaApiTelegram:
+    def __init__(self, latencia=0.0, taxa_429=0.0, taxa_falhas=0.0, retry_after=1, semente=None):
+        self.latencia = latencia
+        self.taxa_429 = taxa_429
+        self.taxa_falhas = taxa_falhas
+        self.retry_after = retry_after
+        self.aleatorio = random.Random(semente)
+
+        self.pendentes = []  # updates aguardando getUpdates
+        self.novos_updates = asyncio.Event()
+        self.webhook_url = None
+        self.webhook_segredo = None
+        self.envios = []  # (instante, metodo, chat_id, parametros)
+        self.novo_envio = asyncio.Condition()
+        self.contagem = {"429": 0, "falhas": 0}
+        self._ids_update = itertools.count(1)
+        self._ids_mensagem = itertools.count(1)
+        self._runner = None
+        self._sessao = None
+        self.url = None
+
+    # 🔹 Ciclo de vida
+    async def iniciar(self, host="127.0.0.1", porta=0):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{metodo}", self._tratar)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, porta)
+        await site.start()
+        porta = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{porta}/bot"
+        self._sessao = aiohttp.ClientSession()
+        return self
+
+    async def parar(self):
+        if self._sessao:
+            await self._sessao.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    # 🔹 Injeção de updates
+    def _mensagem(self, chat_id, texto=None, nome="Teste", username=None, **extras):
+        mensagem = {
+            "message_id": next(self._ids_mensagem),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": int(chat_id), "is_bot": False, "first_name": nome, "username": username},
+        }
+        if texto is not None:
+            mensagem["text"] = texto
+            if texto.startswith("/"):
+                mensagem["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        mensagem.update(extras)
+        return mensagem
+
+    async def enviar_update(self, chat_id, texto=None, editada=None, **extras):
+        """
+        Entrega um update ao bot (via webhook, se registrado, ou via getUpdates).
+        Com `editada` (message_id), vira um edited_message, como as atualizações de localização em tempo real.
+        """
+        mensagem = self._mensagem(chat_id, texto, **extras)
+        if editada is None:
+            update = {"update_id": next(self._ids_update), "message": mensagem}
+        else:
+            mensagem.update(message_id=editada, edit_date=int(time.time()))
+            update = {"update_id": next(self._ids_update), "edited_message": mensagem}
+        if self.webhook_url:
+            cabecalhos = {"X-Telegram-Bot-Api-Secret-Token": self.webhook_segredo or ""}
+            async with self._sessao.post(self.webhook_url, json=update, headers=cabecalhos) as resposta:
+                resposta.raise_for_status()
+        else:
+            self.pendentes.append(update)
+            self.novos_updates.set()
+        return update
+
+    async def aguardar_envio(self, predicado, timeout=10.0):
+        """ Espera um envio que satisfaça o predicado e retorna o instante em que chegou """
+        async with self.novo_envio:
+            inicio = 0
+            while True:
+                for instante, metodo, chat_id, parametros in self.envios[inicio:]:
+                    if predicado(metodo, chat_id, parametros):
+                        return instante
+                inicio = len(self.envios)
+                await asyncio.wait_for(self.novo_envio.wait(), timeout)
+
+    # 🔹 Tratamento das chamadas
+    async def _parametros(self, request):
+        if request.content_type == "application/json":
+            return await request.json()
+        parametros = {}
+        for chave, valor in (await request.post()).items():
+            if isinstance(valor, str):
+                try:
+                    valor = json.loads(valor)
+                except ValueError:
+                    pass
+            else:
+                valor = valor.file.read()  # Upload de arquivo (multipart)
+            parametros[chave] = valor
+        return parametros
+
+    async def _tratar(self, request):
+        metodo = request.match_info["metodo"]
+        parametros = await self._parametros(request)
+
+        if metodo == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Guardiao", "username": "guardiao_bot"})
+        if metodo == "deleteWebhook":
+            self.webhook_url = None
+            return self._ok(True)
+        if metodo == "setWebhook":
+            self.webhook_url = parametros.get("url")
+            self.webhook_segredo = parametros.get("secret_token")
+            return self._ok(True)
+        if metodo == "getUpdates":
+            return await self._get_updates(parametros)
+        if metodo not in METODOS_DE_ENVIO:
+            return self._ok(True)
+
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        sorteio = self.aleatorio.random()
+        if sorteio < self.taxa_429:
+            self.contagem["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        if sorteio < self.taxa_429 + self.taxa_falhas:
+            self.contagem["falhas"] += 1
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+
+        chat_id = str(parametros.get("chat_id"))
+        async with self.novo_envio:
+            self.envios.append((time.monotonic(), metodo, chat_id, parametros))
+            self.novo_envio.notify_all()
+        return self._ok(self._resposta_envio(metodo, chat_id, parametros))
+
+    async def _get_updates(self, parametros):
+        offset = int(parametros.get("offset") or 0)
+        self.pendentes = [u for u in self.pendentes if u["update_id"] >= offset]
+        if not self.pendentes:
+            self.novos_updates.clear()
+            try:
+                await asyncio.wait_for(self.novos_updates.wait(), float(parametros.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._ok(list(self.pendentes))
+
+    def _resposta_envio(self, metodo, chat_id, parametros):
+        if metodo == "copyMessage":
+            return {"message_id": next(self._ids_mensagem)}
+        mensagem = {
+            "message_id": next(self._ids_mensagem),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+        }
+        if "text" in parametros:
+            mensagem["text"] = parametros["text"]
+        if metodo == "sendAudio":
+            mensagem["audio"] = {"file_id": "audio-falso", "file_unique_id": "audio-falso", "duration": 1}
+        return mensagem
+
+    @staticmethod
+    def _ok(resultado):
+        return web.json_response({"ok": True, "result": resultado})
@@ -0,0 +1,214 @@
+"""
+Teste de carga do Guardião Escolar contra a Bot API falsa.
+
+Sobe a Bot API falsa (com latência, respostas 429 e falhas configuráveis) e um servidor
+local com uma planilha sintética de N escolas. Em seguida dispara M emergências
+simultâneas (uma por escola) junto com uma enxurrada de mensagens de chats não
+cadastrados (que chegam aos administradores em resumos periódicos), e mede o tempo entre cada update e a entrega do alerta ao último
+administrador.
+
+Com os limites reais do Telegram (1 msg/s por chat de administrador), o tempo total é
+dominado por eles; use --limite-por-chat / --limite-global para medir só o bot.
+
+Uso: python benchmarks/teste_de_carga.py --escolas 500 --emergencias 100 --desconhecidos 300
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from falsa_api_telegram import FalsaApiTelegram
+
+DIRETORIO_TEMPORARIO = tempfile.mkdtemp(prefix="guardiao_carga_")
+# A configuração do bot é lida na importação: arquivos locais vão para um diretório temporário
+os.environ.setdefault("ARQUIVO_SNAPSHOT_PLANILHA", os.path.join(DIRETORIO_TEMPORARIO, "planilha.sqlite3"))
+os.environ.setdefault("ARQUIVO_CACHE_AUDIOS", os.path.join(DIRETORIO_TEMPORARIO, "cache_audios.json"))
+os.environ.setdefault("ARQUIVO_CAIXA_SAIDA", os.path.join(DIRETORIO_TEMPORARIO, "caixa_saida.jsonl"))
+os.environ.setdefault("ARQUIVO_HISTORICO", os.path.join(DIRETORIO_TEMPORARIO, "historico.sqlite3"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import guardiao_bot  # noqa: E402
+
+TOKEN = "123:carga"
+PRIMEIRO_CHAT_ESCOLA = 1_000_000
+PRIMEIRO_CHAT_DESCONHECIDO = 5_000_000
+PRIMEIRO_CHAT_ADMIN = 9_000_000
+
+
+def gerar_planilha(escolas):
+    linhas = ["Chat ID,Escola,Região,Nome,Função,Telefone,Email,Endereço,Localização"]
+    for i in range(escolas):
+        linhas.append(
+            f"{PRIMEIRO_CHAT_ESCOLA + i},Escola Carga {i:05d},Região {i % 20},Servidor {i},Diretor,"
+            f"(61) 90000-{i % 10000:04d},escola{i}@carga.local,Quadra {i},"
+            f"\"{-15.7 - (i % 100) / 1000:.4f},{-47.8 - (i // 100) / 1000:.4f}\""
+        )
+    return ("\n".join(linhas) + "\n").encode("utf-8")
+
+
+async def iniciar_servidor_planilha(conteudo):
+    etag = '"' + hashlib.sha256(conteudo).hexdigest()[:16] + '"'
+
+    async def planilha(request):
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+        return web.Response(body=conteudo, content_type="text/csv", headers={"ETag": etag})
+
+    servidor = web.Application()
+    servidor.router.add_get("/planilha.csv", planilha)
+    runner = web.AppRunner(servidor, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    porta = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{porta}/planilha.csv"
+
+
+def percentil(valores, p):
+    if not valores:
+        return float("nan")
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+async def executar(args):
+    api = await FalsaApiTelegram(
+        latencia=args.latencia / 1000, taxa_429=args.taxa_429, taxa_falhas=args.taxa_falhas, semente=42
+    ).iniciar()
+    runner_planilha, url_planilha = await iniciar_servidor_planilha(gerar_planilha(args.escolas))
+
+    admins = [str(PRIMEIRO_CHAT_ADMIN + i) for i in range(args.admins)]
+    guardiao_bot.CSV_URL = url_planilha
+    if args.limite_por_chat:
+        guardiao_bot.LIMITE_POR_CHAT_POR_SEGUNDO = args.limite_por_chat
+    if args.limite_global:
+        guardiao_bot.balde_global = guardiao_bot.BaldeDeTokens(args.limite_global, args.limite_global)
+    guardiao_bot.ADMIN_CHAT_IDS[:] = admins
+    guardiao_bot.INTERVALO_RESUMO_DESCONHECIDOS = args.intervalo_resumo
+
+    application = guardiao_bot.criar_aplicacao(TOKEN, base_url=api.url)
+    await application.initialize()
+    await guardiao_bot.iniciar_tarefas(application)
+    await asyncio.wait_for(guardiao_bot.planilha_pronta.wait(), 30)
+
+    runner_webhook = None
+    if args.modo == "webhook":
+        runner_webhook = await guardiao_bot.iniciar_servidor_webhook(
+            application, "127.0.0.1", args.porta_webhook, "/telegram", "carga"
+        )
+        await application.bot.set_webhook(f"http://127.0.0.1:{args.porta_webhook}/telegram", secret_token="carga")
+    else:
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+    await application.start()
+
+    print(
+        f"🏫 {args.escolas} escolas | 🚨 {args.emergencias} emergências | 👤 {args.desconhecidos} desconhecidos"
+        f" | 👮 {args.admins} admins | modo {args.modo}"
+    )
+
+    # Updates na ordem em que chegariam: emergências misturadas à enxurrada de desconhecidos
+    updates = [("emergencia", i) for i in range(args.emergencias)]
+    updates += [("desconhecido", i) for i in range(args.desconhecidos)]
+    updates.sort(key=lambda item: (item[1] * (args.emergencias + args.desconhecidos)) // (
+        args.emergencias if item[0] == "emergencia" else args.desconhecidos))
+
+    enviados_em = {}
+    inicio = time.monotonic()
+    for tipo, i in updates:
+        if tipo == "emergencia":
+            enviados_em[i] = time.monotonic()
+            await api.enviar_update(PRIMEIRO_CHAT_ESCOLA + i, f"AGRESSOR armado no bloco {i}, alunos trancados")
+        else:
+            await api.enviar_update(PRIMEIRO_CHAT_DESCONHECIDO + i, "oi, quem é?")
+
+    # Espera cada alerta chegar a todos os administradores
+    entregues = {}
+    admins_set = set(admins)
+    limite = time.monotonic() + args.timeout
+    while len(entregues) < args.emergencias and time.monotonic() < limite:
+        await asyncio.sleep(0.05)
+        chegadas = {}
+        for instante, metodo, chat_id, parametros in list(api.envios):
+            texto = parametros.get("text", "") if isinstance(parametros, dict) else ""
+            if metodo != "sendMessage" or chat_id not in admins_set or "ALERTA DE EMERG" not in texto:
+                continue
+            posicao = texto.find("Escola Carga ")
+            if posicao < 0:
+                continue
+            escola = int(texto[posicao + 13:posicao + 18])
+            chegadas.setdefault(escola, {})[chat_id] = instante
+        entregues = {
+            escola: max(por_admin.values()) for escola, por_admin in chegadas.items() if len(por_admin) == len(admins)
+        }
+    duracao = time.monotonic() - inicio
+
+    # Os desconhecidos chegam aos administradores em resumo: espera o primeiro
+    if args.desconhecidos:
+        try:
+            await api.aguardar_envio(
+                lambda metodo, chat_id, parametros: chat_id in admins_set and "tentando interagir" in str(parametros.get("text", "")),
+                timeout=args.intervalo_resumo + 5,
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    latencias = [(entregues[i] - enviados_em[i]) * 1000 for i in entregues]
+    resumos_desconhecidos = sum(
+        1 for _, metodo, chat_id, parametros in api.envios
+        if chat_id in admins_set and "tentando interagir" in str(parametros.get("text", ""))
+    )
+    respostas_desconhecidos = sum(1 for _, _, chat_id, _ in api.envios if int(chat_id) >= PRIMEIRO_CHAT_DESCONHECIDO and int(chat_id) < PRIMEIRO_CHAT_ADMIN)
+    fila = guardiao_bot.despachante.metricas()
+
+    print(f"⏱️ Duração: {duracao:.2f} s | chamadas à API: {len(api.envios)} | 429: {api.contagem['429']} | falhas: {api.contagem['falhas']}")
+    print(f"🚨 Alertas entregues a todos os admins: {len(entregues)}/{args.emergencias} ({len(entregues) / duracao:.1f} alertas/s)")
+    if latencias:
+        print(
+            f"📨 Latência update → último admin: p50 {percentil(latencias, 50):.1f} ms | p95 {percentil(latencias, 95):.1f} ms"
+            f" | p99 {percentil(latencias, 99):.1f} ms | média {statistics.mean(latencias):.1f} ms"
+        )
+    print(f"👤 Desconhecidos: {respostas_desconhecidos} respostas automáticas | {resumos_desconhecidos} resumo(s) entregues aos admins")
+    print("📥 Fila: " + ", ".join(
+        f"{classe} (enviados {valores['enviados']}, descartados {valores['descartados']}, espera máx {valores['espera_maxima'] * 1000:.0f} ms)"
+        for classe, valores in fila.items()
+    ))
+
+    if application.updater.running:
+        await application.updater.stop()
+    await application.stop()
+    if runner_webhook:
+        await runner_webhook.cleanup()
+    await guardiao_bot.encerrar_tarefas(application)
+    await application.shutdown()
+    await runner_planilha.cleanup()
+    await api.parar()
+    return len(entregues) == args.emergencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--escolas", type=int, default=500)
+    parser.add_argument("--emergencias", type=int, default=50)
+    parser.add_argument("--desconhecidos", type=int, default=200)
+    parser.add_argument("--admins", type=int, default=3)
+    parser.add_argument("--latencia", type=float, default=20, help="latência da Bot API falsa (ms)")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="fração de envios respondidos com 429")
+    parser.add_argument("--taxa-falhas", type=float, default=0.0, help="fração de envios respondidos com 502")
+    parser.add_argument("--limite-por-chat", type=float, help="sobrescreve o limite de envios por chat (por segundo)")
+    parser.add_argument("--limite-global", type=float, help="sobrescreve o limite global de envios (por segundo)")
+    parser.add_argument("--intervalo-resumo", type=float, default=1.0, help="intervalo (s) entre resumos de desconhecidos")
+    parser.add_argument("--modo", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--porta-webhook", type=int, default=8912)
+    parser.add_argument("--timeout", type=float, default=120, help="espera máxima pelas entregas (s)")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(executar(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
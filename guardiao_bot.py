@@ -1,62 +1,1834 @@
 import os
-import requests
 import csv
-import threading
 import time
 import unicodedata
 import asyncio
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackContext, filters
+import bisect
+import codecs
+import collections
+import hashlib
+import hmac
+import io
+import itertools
+import heapq
+import json
+import math
+import random
+import re
+import secrets
+import sqlite3
+from contextlib import closing
+from functools import lru_cache
+from types import MappingProxyType
+import aiohttp
+from aiohttp import web
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, CallbackContext, filters
 
 
 # Configurações
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CSV_URL = os.getenv("CSV_URL")
-ADMIN_CHAT_IDS = os.getenv("ADMIN_CHAT_IDS", "").split(",")
-
-dados_planilha = []
-emergencia_ativa = False
-
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Opcional: outra Bot API (ex.: servidor local de testes)
+MODO_RECEBIMENTO = os.getenv("MODO_RECEBIMENTO", "polling").lower()  # "polling" ou "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL pública que o Telegram vai chamar
+WEBHOOK_CAMINHO = os.getenv("WEBHOOK_CAMINHO", "/telegram")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORTA = int(os.getenv("WEBHOOK_PORTA", os.getenv("PORT", "8443")))
+WEBHOOK_SEGREDO = os.getenv("WEBHOOK_SEGREDO") or secrets.token_urlsafe(32)
+DIRETORIO_BASE = os.path.dirname(os.path.abspath(__file__))
+ARQUIVO_PALAVRAS_CHAVE = os.getenv("ARQUIVO_PALAVRAS_CHAVE")  # JSON opcional com a tabela de palavras-chave
+ARQUIVO_SNAPSHOT_PLANILHA = os.getenv("ARQUIVO_SNAPSHOT_PLANILHA", os.path.join(DIRETORIO_BASE, "planilha.sqlite3"))
+TEMPO_ESPERA_PLANILHA = float(os.getenv("TEMPO_ESPERA_PLANILHA", "10"))  # segundos
+ARQUIVO_CACHE_AUDIOS = os.getenv("ARQUIVO_CACHE_AUDIOS", os.path.join(DIRETORIO_BASE, "cache_audios.json"))
+ARQUIVO_HISTORICO = os.getenv("ARQUIVO_HISTORICO", os.path.join(DIRETORIO_BASE, "historico.sqlite3"))
+ARQUIVO_CAIXA_SAIDA = os.getenv("ARQUIVO_CAIXA_SAIDA", os.path.join(DIRETORIO_BASE, "caixa_saida.jsonl"))
+INTERVALO_REENVIO_PENDENTES = float(os.getenv("INTERVALO_REENVIO_PENDENTES", "60"))  # segundos entre novas tentativas da caixa de saída
+# Administradores = supervisores globais: recebem todos os alertas e todos os avisos do sistema
+UNIDADES_MAIS_PROXIMAS = int(os.getenv("UNIDADES_MAIS_PROXIMAS", "3"))  # Unidades acionadas primeiro em cada alerta
+VALIDADE_POSICAO_UNIDADE = float(os.getenv("VALIDADE_POSICAO_UNIDADE", "7200"))  # segundos
+RAIO_MAXIMO_UNIDADES_KM = float(os.getenv("RAIO_MAXIMO_UNIDADES_KM", "50"))  # Unidades mais distantes não são acionadas primeiro (0 = sem limite)
+ADMIN_CHAT_IDS = [c.strip() for c in os.getenv("ADMIN_CHAT_IDS", "").split(",") if c.strip()]
+ROTAS_CSV_URL = os.getenv("ROTAS_CSV_URL")  # Opcional: planilha Região/Escola -> Chat ID das equipes de resposta
+JANELA_INCIDENTE = float(os.getenv("JANELA_INCIDENTE", "600"))  # segundos sem novidades até o incidente expirar
+INTERVALO_VARREDURA_INCIDENTES = float(os.getenv("INTERVALO_VARREDURA_INCIDENTES", "60"))  # segundos entre buscas por incidentes expirados
+INTERVALO_AGRUPAMENTO = float(os.getenv("INTERVALO_AGRUPAMENTO", "5"))  # segundos para juntar atualizações
+INTERVALO_LOCALIZACAO_AO_VIVO = float(os.getenv("INTERVALO_LOCALIZACAO_AO_VIVO", "60"))  # segundos entre repasses
+DISTANCIA_MINIMA_LOCALIZACAO = float(os.getenv("DISTANCIA_MINIMA_LOCALIZACAO", "50"))  # metros
+
+@lru_cache(maxsize=4096)
 def normalizar_texto(texto):
     return unicodedata.normalize('NFKD', texto).encode('ASCII', 'ignore').decode('utf-8').upper()
 
-def internet_disponivel():
+# 🔹 Tabela de palavras-chave: categoria -> prioridade (menor = mais urgente) e termos/sinônimos
+PALAVRAS_CHAVE_PADRAO = {
+    "AGRESSOR": {"prioridade": 1, "termos": ["AGRESSOR", "ATIRADOR"]},
+    "HOMICIDIO": {"prioridade": 1, "termos": ["HOMICIDIO"]},
+    "REFEM": {"prioridade": 1, "termos": ["REFEM", "REFENS"]},
+    "BOMBA": {"prioridade": 1, "termos": ["BOMBA", "EXPLOSIVO"]},
+    "SOCORRO": {"prioridade": 2, "termos": ["SOCORRO"]},
+    "TESTE": {"prioridade": 9, "termos": ["TESTE"]},
+}
+
+class ClassificadorEmergencias:
+    """
+    Classifica o texto normalizado em uma única passada, usando uma só expressão
+    regular (alternância compilada) montada a partir da tabela de palavras-chave.
+    """
+
+    def __init__(self, tabela):
+        self.prioridades = {}
+        self.categoria_do_termo = {}
+        for categoria, config in tabela.items():
+            self.prioridades[categoria] = config["prioridade"]
+            for termo in config["termos"]:
+                self.categoria_do_termo[normalizar_texto(termo)] = categoria
+
+        # Termos mais longos primeiro, para que "REFENS" tenha preferência sobre prefixos menores
+        termos = sorted(self.categoria_do_termo, key=len, reverse=True)
+        self.padrao = re.compile("|".join(re.escape(termo) for termo in termos))
+
+    def classificar(self, texto):
+        """
+        Retorna todas as categorias encontradas como [(prioridade, categoria)],
+        da mais urgente para a menos urgente (empates em ordem alfabética).
+        """
+        categorias = {self.categoria_do_termo[m.group()] for m in self.padrao.finditer(normalizar_texto(texto))}
+        return sorted((self.prioridades[categoria], categoria) for categoria in categorias)
+
+def carregar_palavras_chave():
+    if not ARQUIVO_PALAVRAS_CHAVE:
+        return PALAVRAS_CHAVE_PADRAO
     try:
-        response = requests.get("https://www.google.com", timeout=3)
-        return response.status_code == 200
-    except requests.RequestException:
-        return False
+        with open(ARQUIVO_PALAVRAS_CHAVE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"❌ Erro ao carregar palavras-chave ({ARQUIVO_PALAVRAS_CHAVE}), usando a tabela padrão: {e}")
+        return PALAVRAS_CHAVE_PADRAO
+
+classificador = ClassificadorEmergencias(carregar_palavras_chave())
+
+def normalizar_chat_id(chat_id):
+    """ Converte o Chat ID para a forma canônica usada como chave do índice """
+    chave = str(chat_id).strip()
+    # Planilhas exportam números como "123.0" quando a coluna vira decimal
+    if chave.endswith(".0") and chave[:-2].lstrip("-").isdigit():
+        chave = chave[:-2]
+    return chave
+
+def normalizar_chave(texto):
+    return " ".join(normalizar_texto(str(texto or "")).split())
+
+# 🔹 Templates de alerta (parte fixa de cada escola renderizada uma única vez e guardada no índice)
+CARACTERES_MARKDOWN = re.compile(r"([_*`\[])")
+
+def escapar_markdown(texto):
+    """ Escapa os caracteres especiais do Markdown (legado) do Telegram """
+    return CARACTERES_MARKDOWN.sub(r"\\\1", str(texto if texto is not None else ""))
+
+def renderizar_cabecalho_escola(linha):
+    """ Bloco fixo da escola/servidor, já escapado; montado uma vez por linha da planilha """
+    return (
+        f"🏫 *Escola*: {escapar_markdown(linha.get('Escola'))}\n"
+        f"👤 *Servidor*: {escapar_markdown(linha.get('Nome'))}\n"
+        f"👤 *Função*: {escapar_markdown(linha.get('Função'))}\n"
+        f"📞 *Telefone*: {escapar_markdown(linha.get('Telefone'))}\n"
+        f"✉️ *Email*: {escapar_markdown(linha.get('Email'))}\n"
+        f"📍 *Endereço*: {escapar_markdown(linha.get('Endereço'))}\n"
+        f"🌐 *Localização*: {escapar_markdown(linha.get('Localização'))}\n"
+    )
+
+# 🔹 Coordenadas: coluna Localização da planilha e posição das unidades de resposta
+PADRAO_COORDENADAS = re.compile(r"(?<![\d.])(-?\d{1,2}\.\d+)\s*[,;]\s*(-?\d{1,3}\.\d+)(?![\d.])")
+RAIO_TERRA_KM = 6371.0
+TAMANHO_CELULA_GRADE = 0.05  # graus (~5,5 km de latitude)
+
+def extrair_coordenadas(texto):
+    """ (lat, lon) de "-15.79,-47.88", "-15.79; -47.88" ou de um link de mapa; None se não houver.
+    Os dois números precisam ter casas decimais, para não confundir endereços como "Lote 5, 10" """
+    encontrado = PADRAO_COORDENADAS.search(str(texto or ""))
+    if not encontrado:
+        return None
+    lat, lon = float(encontrado.group(1)), float(encontrado.group(2))
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+def distancia_km(origem, destino):
+    """ Distância de haversine entre dois pontos (lat, lon) """
+    lat1, lon1 = map(math.radians, origem)
+    lat2, lon2 = map(math.radians, destino)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAIO_TERRA_KM * math.asin(math.sqrt(a))
+
+class GradeEspacial:
+    """
+    Grade uniforme (células de TAMANHO_CELULA_GRADE graus) para busca dos k pontos mais próximos.
+    A busca percorre anéis de células ao redor da origem e para quando o próximo anel
+    já não pode conter nada mais perto que o k-ésimo encontrado (ou passa do raio máximo).
+    Se os anéis restantes tiverem mais células do que as ocupadas (poucas unidades
+    espalhadas), compara direto com todos os pontos. Dentro de cada anel, as distâncias
+    são calculadas em lote (projeção equirretangular) e só os k finalistas recebem a
+    distância exata de haversine.
+    """
+
+    def __init__(self, tamanho_celula=TAMANHO_CELULA_GRADE):
+        self.tamanho_celula = tamanho_celula
+        self.celulas = {}  # (linha, coluna) -> {identificador: (lat, lon)}
+        self.posicoes = {}  # identificador -> célula
+
+    def __len__(self):
+        return len(self.posicoes)
+
+    def _celula(self, lat, lon):
+        return int(math.floor(lat / self.tamanho_celula)), int(math.floor(lon / self.tamanho_celula))
+
+    def mover(self, identificador, lat, lon):
+        celula = self._celula(lat, lon)
+        anterior = self.posicoes.get(identificador)
+        if anterior is not None and anterior != celula:
+            self._tirar(identificador, anterior)
+        self.celulas.setdefault(celula, {})[identificador] = (lat, lon)
+        self.posicoes[identificador] = celula
+
+    def remover(self, identificador):
+        celula = self.posicoes.pop(identificador, None)
+        if celula is not None:
+            self._tirar(identificador, celula)
+
+    def _tirar(self, identificador, celula):
+        pontos = self.celulas.get(celula)
+        if pontos is not None:
+            pontos.pop(identificador, None)
+            if not pontos:
+                del self.celulas[celula]
+
+    def _anel(self, centro, raio):
+        linha, coluna = centro
+        if raio == 0:
+            yield centro
+            return
+        for deslocamento in range(-raio, raio + 1):
+            yield linha - raio, coluna + deslocamento
+            yield linha + raio, coluna + deslocamento
+        for deslocamento in range(-raio + 1, raio):
+            yield linha + deslocamento, coluna - raio
+            yield linha + deslocamento, coluna + raio
+
+    def mais_proximos(self, origem, k, raio_km=None):
+        """ Lista [(distância_km, identificador)] dos k pontos mais próximos (até raio_km), do mais perto ao mais longe """
+        if k <= 0 or not self.posicoes:
+            return []
+        lat0, lon0 = origem
+        escala_lon = math.cos(math.radians(lat0))
+        km_por_grau = math.pi * RAIO_TERRA_KM / 180
+        # Menor distância (km) coberta por um anel de células, no eixo mais estreito
+        km_por_anel = self.tamanho_celula * km_por_grau * min(1.0, escala_lon)
+        centro = self._celula(lat0, lon0)
+        linhas = [linha for linha, _ in self.celulas]
+        colunas = [coluna for _, coluna in self.celulas]
+        raio_maximo = max(
+            abs(centro[0] - min(linhas)), abs(centro[0] - max(linhas)),
+            abs(centro[1] - min(colunas)), abs(centro[1] - max(colunas)),
+        )
+        if raio_km:
+            raio_maximo = min(raio_maximo, int(raio_km // km_por_anel) + 1)
+
+        melhores = []  # (distância² em graus equivalentes, identificador)
+        examinadas = 0
+        for raio in range(raio_maximo + 1):
+            if len(melhores) >= k and math.sqrt(melhores[-1][0]) * km_por_grau <= (raio - 1) * km_por_anel:
+                break
+            examinadas += 8 * raio or 1
+            if examinadas > len(self.celulas):
+                # Grade esparsa: os anéis já custam mais que olhar cada célula ocupada
+                melhores = heapq.nsmallest(k, [
+                    ((lat - lat0) ** 2 + ((lon - lon0) * escala_lon) ** 2, identificador)
+                    for pontos in self.celulas.values()
+                    for identificador, (lat, lon) in pontos.items()
+                ])
+                break
+            candidatos = [
+                ((lat - lat0) ** 2 + ((lon - lon0) * escala_lon) ** 2, identificador)
+                for celula in self._anel(centro, raio)
+                for identificador, (lat, lon) in self.celulas.get(celula, {}).items()
+            ]
+            if candidatos:
+                melhores = heapq.nsmallest(k, melhores + candidatos)
+        proximos = [
+            (distancia_km(origem, self.celulas[self.posicoes[identificador]][identificador]), identificador)
+            for _, identificador in melhores
+        ]
+        if raio_km:
+            proximos = [(distancia, identificador) for distancia, identificador in proximos if distancia <= raio_km]
+        return proximos
+
+class RegistroUnidades:
+    """
+    Unidades de resposta (equipes e administradores) e a última localização que cada uma
+    compartilhou no Telegram, inclusive a localização em tempo real. Posições mais antigas
+    que VALIDADE_POSICAO_UNIDADE deixam de ser consideradas.
+    """
+
+    def __init__(self, validade):
+        self.validade = validade
+        self.unidades = {}  # chat_id -> {"nome", "lat", "lon", "instante", "ao_vivo"}
+        self.grade = GradeEspacial()
+
+    def atualizar(self, chat_id, nome, lat, lon, ao_vivo=False):
+        self.unidades[chat_id] = {"nome": nome, "lat": lat, "lon": lon, "instante": time.time(), "ao_vivo": ao_vivo}
+        self.grade.mover(chat_id, lat, lon)
+
+    def _expirar(self):
+        limite = time.time() - self.validade
+        for chat_id in [c for c, unidade in self.unidades.items() if unidade["instante"] < limite]:
+            del self.unidades[chat_id]
+            self.grade.remover(chat_id)
+
+    def mais_proximas(self, origem, k=UNIDADES_MAIS_PROXIMAS, raio_km=RAIO_MAXIMO_UNIDADES_KM):
+        """ [(distância_km, chat_id, nome)] das k unidades mais próximas de `origem`, até raio_km """
+        if origem is None:
+            return []
+        self._expirar()
+        return [
+            (distancia, chat_id, self.unidades[chat_id]["nome"])
+            for distancia, chat_id in self.grade.mais_proximos(origem, k, raio_km)
+        ]
+
+unidades_resposta = RegistroUnidades(VALIDADE_POSICAO_UNIDADE)
+
+# 🔹 Roteamento de alertas: cada escola/região tem suas equipes, além dos supervisores globais
+class TabelaRotas:
+    """
+    Planilha de rotas com as colunas Região, Escola e Chat ID (uma equipe por linha).
+    Linhas com Escola preenchida valem só para a escola; as demais, para a região inteira.
+    """
+
+    def __init__(self, linhas=()):
+        self.por_escola = {}
+        self.por_regiao = {}
+        self.linhas = []
+        for linha in linhas:
+            chat_id = normalizar_chat_id(linha.get('Chat ID', ''))
+            if not chat_id:
+                continue
+            self.linhas.append({coluna: linha.get(coluna, '') for coluna in ('Região', 'Escola', 'Chat ID')})
+            if (linha.get('Escola') or '').strip():
+                self.por_escola.setdefault(normalizar_chave(linha.get('Escola')), []).append(chat_id)
+            elif (linha.get('Região') or '').strip():
+                self.por_regiao.setdefault(normalizar_chave(linha.get('Região')), []).append(chat_id)
+        self.equipes = frozenset(normalizar_chat_id(linha['Chat ID']) for linha in self.linhas)
+
+    def __eq__(self, outra):
+        return isinstance(outra, TabelaRotas) and self.linhas == outra.linhas
+
+    def destinatarios(self, linha):
+        """ Supervisores globais primeiro, depois as equipes da região e da escola, sem repetição """
+        escolhidos = list(ADMIN_CHAT_IDS)
+        escolhidos += self.por_regiao.get(normalizar_chave(linha.get('Região')), ())
+        escolhidos += self.por_escola.get(normalizar_chave(linha.get('Escola')), ())
+        return tuple(dict.fromkeys(escolhidos))
+
+tabela_rotas = TabelaRotas()
+
+def eh_equipe(chat_id):
+    """ Administradores e equipes da planilha de rotas (podem atuar nos incidentes e informar posição) """
+    return chat_id in ADMIN_CHAT_IDS or chat_id in tabela_rotas.equipes
+
+def definir_rotas(nova_tabela):
+    global tabela_rotas
+    tabela_rotas = nova_tabela
+
+def conferir_regioes_das_rotas():
+    """ Avisa quando há rotas para regiões que nenhuma linha da planilha de cadastro tem na coluna Região """
+    if not len(indice_escolas) or not tabela_rotas.por_regiao:
+        return []
+    sem_escolas = sorted(regiao for regiao in tabela_rotas.por_regiao if regiao not in indice_escolas.por_regiao)
+    if sem_escolas:
+        print(
+            f"⚠️ Rotas para {len(sem_escolas)} região(ões) sem nenhuma escola na planilha de cadastro "
+            f"(confira a coluna Região): {', '.join(sem_escolas[:10])}"
+        )
+    return sem_escolas
+
+def chave_da_linha(linha):
+    return normalizar_chat_id(linha.get('Chat ID', ''))
+
+class IndiceEscolas:
+    """
+    Índice imutável da planilha de cadastro.
+    Montado uma única vez por carga e publicado de forma atômica (troca de referência),
+    de modo que os handlers nunca enxergam uma planilha carregada pela metade.
+    Cabeçalho, destinatários e coordenadas de cada escola são calculados na primeira
+    consulta e guardados no próprio índice: o boot a partir do snapshot não paga a
+    renderização de milhares de escolas que talvez nunca enviem um alerta.
+    """
+
+    __slots__ = ("por_chat_id", "por_escola", "por_regiao", "cabecalhos", "destinatarios", "coordenadas")
+
+    def __init__(self, linhas=()):
+        por_chat_id = {}
+        for linha in linhas:
+            chave = chave_da_linha(linha)
+            if chave:
+                por_chat_id[chave] = MappingProxyType(dict(linha))  # Em duplicidade, vale a última linha
+
+        por_escola = {}
+        por_regiao = {}
+        normalizadas = {}  # Muitas linhas repetem a mesma escola/região: normaliza cada nome uma vez
+        for linha in por_chat_id.values():
+            for coluna, grupos in (('Escola', por_escola), ('Região', por_regiao)):
+                nome = linha.get(coluna)
+                grupo = normalizadas.get(nome)
+                if grupo is None:
+                    grupo = normalizadas[nome] = normalizar_chave(nome)
+                grupos.setdefault(grupo, []).append(linha)
+
+        self._definir(
+            por_chat_id,
+            {k: tuple(v) for k, v in por_escola.items()},
+            {k: tuple(v) for k, v in por_regiao.items()},
+        )
 
-def carregar_dados_csv():
-    global dados_planilha
+    def _definir(self, por_chat_id, por_escola, por_regiao, cabecalhos=None, destinatarios=None, coordenadas=None):
+        self.por_chat_id = MappingProxyType(por_chat_id)
+        self.por_escola = MappingProxyType(por_escola)
+        self.por_regiao = MappingProxyType(por_regiao)
+        # Caches preenchidos sob demanda (só pelo event loop); entradas válidas sobrevivem aos diffs
+        self.cabecalhos = cabecalhos or {}
+        self.destinatarios = destinatarios or {}  # Chat ID da escola -> quem recebe os alertas
+        self.coordenadas = coordenadas or {}  # Chat ID da escola -> (lat, lon) ou None
+
+    def cabecalho(self, chave):
+        cabecalho = self.cabecalhos.get(chave)
+        if cabecalho is None and chave in self.por_chat_id:
+            cabecalho = self.cabecalhos[chave] = renderizar_cabecalho_escola(self.por_chat_id[chave])
+        return cabecalho
+
+    def destinatarios_de(self, chave):
+        destinatarios = self.destinatarios.get(chave)
+        if destinatarios is None and chave in self.por_chat_id:
+            destinatarios = self.destinatarios[chave] = tabela_rotas.destinatarios(self.por_chat_id[chave])
+        return destinatarios
+
+    def coordenadas_de(self, chave):
+        """ (lat, lon) da escola; None se a linha não tiver coordenadas. KeyError se o Chat ID não estiver no índice """
+        if chave not in self.coordenadas:
+            self.coordenadas[chave] = extrair_coordenadas(self.por_chat_id[chave].get('Localização'))
+        return self.coordenadas[chave]
+
+    def com_rotas(self):
+        """ Novo índice cujos destinatários serão recalculados com a tabela de rotas atual """
+        novo = IndiceEscolas.__new__(IndiceEscolas)
+        novo._definir(
+            dict(self.por_chat_id), dict(self.por_escola), dict(self.por_regiao), dict(self.cabecalhos), {}, dict(self.coordenadas),
+        )
+        return novo
+
+    def __len__(self):
+        return len(self.por_chat_id)
+
+    def __iter__(self):
+        return iter(self.por_chat_id.values())
+
+    def buscar(self, chat_id):
+        return self.por_chat_id.get(normalizar_chat_id(chat_id))
+
+    def buscar_por_escola(self, escola):
+        return self.por_escola.get(normalizar_chave(escola), ())
+
+    def buscar_por_regiao(self, regiao):
+        return self.por_regiao.get(normalizar_chave(regiao), ())
+
+    def aplicar_diff(self, alteradas, removidas):
+        """
+        Retorna um novo índice com as linhas alteradas/removidas aplicadas.
+        Só os grupos (escola/região) afetados são reconstruídos; o restante é compartilhado.
+        """
+        por_chat_id = dict(self.por_chat_id)
+        escolas_afetadas = set()
+        regioes_afetadas = set()
+
+        for chave in list(alteradas) + list(removidas):
+            antiga = por_chat_id.get(chave)
+            if antiga is not None:
+                escolas_afetadas.add(normalizar_chave(antiga.get('Escola')))
+                regioes_afetadas.add(normalizar_chave(antiga.get('Região')))
+
+        for chave in removidas:
+            por_chat_id.pop(chave, None)
+        for chave, linha in alteradas.items():
+            linha = MappingProxyType(dict(linha))
+            por_chat_id[chave] = linha
+            escolas_afetadas.add(normalizar_chave(linha.get('Escola')))
+            regioes_afetadas.add(normalizar_chave(linha.get('Região')))
+
+        tocadas = set(alteradas) | set(removidas)
+        cabecalhos = dict(self.cabecalhos)
+        destinatarios = dict(self.destinatarios)
+        coordenadas = dict(self.coordenadas)
+        for chave in tocadas:
+            cabecalhos.pop(chave, None)
+            destinatarios.pop(chave, None)
+            coordenadas.pop(chave, None)
+
+        def reconstruir(grupos_antigos, afetados, coluna):
+            # Os grupos afetados são montados em listas e viram tupla uma única vez
+            novos = {
+                grupo: [linha for linha in grupos_antigos.get(grupo, ()) if chave_da_linha(linha) not in tocadas]
+                for grupo in afetados
+            }
+            for chave in alteradas:
+                linha = por_chat_id[chave]
+                novos[normalizar_chave(linha.get(coluna))].append(linha)
+            grupos = dict(grupos_antigos)
+            for grupo, linhas in novos.items():
+                if linhas:
+                    grupos[grupo] = tuple(linhas)
+                else:
+                    grupos.pop(grupo, None)
+            return grupos
+
+        novo = IndiceEscolas.__new__(IndiceEscolas)
+        novo._definir(
+            por_chat_id,
+            reconstruir(self.por_escola, escolas_afetadas, 'Escola'),
+            reconstruir(self.por_regiao, regioes_afetadas, 'Região'),
+            cabecalhos,
+            destinatarios,
+            coordenadas,
+        )
+        return novo
+
+indice_escolas = IndiceEscolas()
+
+def publicar_indice(novo_indice):
+    """ Publica o índice com uma única atribuição (atômica sob o GIL) """
+    global indice_escolas
+    indice_escolas = novo_indice
+    return novo_indice
+
+# 🔹 Estado da atualização condicional da planilha
+INTERVALO_ATUALIZACAO = float(os.getenv("INTERVALO_ATUALIZACAO", "300"))  # segundos
+JITTER_ATUALIZACAO = float(os.getenv("JITTER_ATUALIZACAO", "30"))  # segundos (±)
+BACKOFF_INICIAL_ATUALIZACAO = float(os.getenv("BACKOFF_INICIAL_ATUALIZACAO", "30"))  # segundos
+BACKOFF_MAXIMO_ATUALIZACAO = float(os.getenv("BACKOFF_MAXIMO_ATUALIZACAO", "1800"))  # segundos
+
+LIMITE_DIFF_NO_LOOP = 1000  # linhas; diffs maiores são aplicados em uma thread
+estado_planilha = {"etag": None, "last_modified": None, "hash": None}
+estado_rotas = {"etag": None, "last_modified": None}
+ultima_atualizacao = {}
+planilha_pronta = asyncio.Event()  # Liberado quando há um índice válido (snapshot local ou download)
+
+# 🔹 Snapshot local da planilha (SQLite), usado no boot e quando a CSV_URL está fora do ar
+class SnapshotPlanilha:
+    """
+    Cópia local da última planilha carregada com sucesso.
+    Cada atualização grava só as linhas alteradas/removidas, junto com o ETag e o hash,
+    em uma única transação, para que snapshot e metadados nunca fiquem dessincronizados.
+    """
+
+    VERSAO = 1
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho)
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute("CREATE TABLE IF NOT EXISTS linhas (chave TEXT PRIMARY KEY, dados TEXT NOT NULL)")
+        conexao.execute("CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT)")
+        return conexao
+
+    def carregar(self):
+        """ Retorna (linhas, metadados) ou None se não houver snapshot utilizável """
+        if not os.path.exists(self.caminho):
+            return None
+        with closing(self._conectar()) as conexao:
+            meta = dict(conexao.execute("SELECT chave, valor FROM meta"))
+            if meta.get("versao") != str(self.VERSAO):
+                return None
+            # Um único json.loads para todas as linhas: bem mais rápido que uma chamada por linha
+            linhas = json.loads("[" + ",".join(dados for (dados,) in conexao.execute("SELECT dados FROM linhas")) + "]")
+        return linhas, {chave: meta.get(chave) for chave in (*estado_planilha, "rotas")}
+
+    def gravar(self, alteradas, removidas, metadados):
+        with closing(self._conectar()) as conexao, conexao:
+            conexao.executemany(
+                "INSERT OR REPLACE INTO linhas (chave, dados) VALUES (?, ?)",
+                ((chave, json.dumps(dict(linha), ensure_ascii=False)) for chave, linha in alteradas.items()),
+            )
+            conexao.executemany("DELETE FROM linhas WHERE chave = ?", ((chave,) for chave in removidas))
+            conexao.executemany(
+                "INSERT OR REPLACE INTO meta (chave, valor) VALUES (?, ?)",
+                [("versao", str(self.VERSAO))] + list(metadados.items()),
+            )
+
+snapshot_planilha = SnapshotPlanilha(ARQUIVO_SNAPSHOT_PLANILHA)
+
+def carregar_snapshot():
+    """ Publica o índice a partir do snapshot local; chamado no boot, antes de receber mensagens """
+    inicio = time.perf_counter()
     try:
-        response = requests.get(CSV_URL)
+        snapshot = snapshot_planilha.carregar()
+    except (sqlite3.Error, ValueError) as e:
+        print(f"❌ Snapshot local da planilha ilegível, aguardando download: {e}")
+        return False
+    if snapshot is None:
+        print("ℹ️ Nenhum snapshot local da planilha; aguardando o primeiro download.")
+        return False
+
+    linhas, metadados = snapshot
+    rotas = metadados.pop("rotas", None)
+    if rotas:
+        definir_rotas(TabelaRotas(json.loads(rotas)))
+    publicar_indice(IndiceEscolas(linhas))
+    estado_planilha.update(metadados)
+    planilha_pronta.set()
+    conferir_regioes_das_rotas()
+    print(f"✅ Planilha carregada do snapshot local ({len(indice_escolas)} cadastros em {(time.perf_counter() - inicio) * 1000:.1f} ms)")
+    return True
+
+def registros_csv(linhas):
+    """
+    Agrupa linhas físicas em registros CSV completos à medida que chegam.
+    Um registro termina quando o total de aspas acumulado é par (campos com quebra de linha).
+    """
+    pendente = []
+    aspas = 0
+    for linha in linhas:
+        pendente.append(linha)
+        aspas += linha.count('"')
+        if aspas % 2 == 0:
+            yield from csv.reader(pendente)
+            pendente = []
+            aspas = 0
+    if pendente:
+        yield from csv.reader(pendente)
+
+class LeitorCsvIncremental:
+    """ Recebe pedaços de bytes da resposta e devolve as linhas da planilha já como dicts """
+
+    def __init__(self):
+        self.decodificador = codecs.getincrementaldecoder('utf-8-sig')()
+        self.resto = ""
+        self.cabecalho = None
+
+    def _linhas_para_dicts(self, linhas):
+        for campos in registros_csv(linhas):
+            if not campos:
+                continue
+            if self.cabecalho is None:
+                self.cabecalho = campos
+                continue
+            yield dict(zip(self.cabecalho, campos))
+
+    def alimentar(self, pedaco):
+        texto = self.resto + self.decodificador.decode(pedaco)
+        linhas = texto.split("\n")
+        # Só processa registros cujas aspas já fecharam; o restante espera o próximo pedaço
+        completas, self.resto = linhas[:-1], linhas[-1]
+        aspas = 0
+        corte = 0
+        for i, linha in enumerate(completas):
+            aspas += linha.count('"')
+            if aspas % 2 == 0:
+                corte = i + 1
+        self.resto = "\n".join(completas[corte:] + [self.resto])
+        return list(self._linhas_para_dicts(l.rstrip("\r") + "\n" for l in completas[:corte]))
+
+    def finalizar(self):
+        texto = self.resto + self.decodificador.decode(b"", final=True)
+        self.resto = ""
+        return list(self._linhas_para_dicts(l.rstrip("\r") + "\n" for l in texto.split("\n")))
+
+async def carregar_dados_csv(sessao):
+    """
+    Baixa a planilha de forma condicional (ETag / If-Modified-Since + hash do conteúdo)
+    e aplica ao índice apenas as linhas que mudaram.
+    Retorna as estatísticas da atualização (bytes e linhas efetivamente tocados).
+    """
+    estatisticas = {"status": "erro", "bytes": 0, "linhas_lidas": 0, "linhas_alteradas": 0, "linhas_removidas": 0}
+    cabecalhos = {}
+    if estado_planilha["etag"]:
+        cabecalhos["If-None-Match"] = estado_planilha["etag"]
+    if estado_planilha["last_modified"]:
+        cabecalhos["If-Modified-Since"] = estado_planilha["last_modified"]
+
+    async with sessao.get(CSV_URL, headers=cabecalhos) as response:
+        if response.status == 304:
+            estatisticas["status"] = "nao_modificada"
+            print("✅ Planilha sem alterações (304).")
+            return estatisticas
         response.raise_for_status()
-        decoded_content = response.content.decode('utf-8')
-        reader = csv.DictReader(decoded_content.splitlines())
-        dados_planilha = list(reader)
-        print("✅ Planilha atualizada com sucesso!")
-    except Exception as e:
-        print(f"❌ Erro ao carregar a planilha: {e}")
+
+        indice_atual = indice_escolas
+        leitor = LeitorCsvIncremental()
+        resumo = hashlib.sha256()
+        alteradas = {}
+        vistas = set()
+
+        def comparar(linhas):
+            for linha in linhas:
+                chave = chave_da_linha(linha)
+                if not chave:
+                    continue
+                estatisticas["linhas_lidas"] += 1
+                vistas.add(chave)
+                # Chat ID repetido: vale a última linha, como na montagem completa do índice
+                if indice_atual.por_chat_id.get(chave) != linha:
+                    alteradas[chave] = linha
+                else:
+                    alteradas.pop(chave, None)
+
+        async for pedaco in response.content.iter_chunked(64 * 1024):
+            estatisticas["bytes"] += len(pedaco)
+            resumo.update(pedaco)
+            comparar(leitor.alimentar(pedaco))
+        comparar(leitor.finalizar())
+
+        estado_planilha["etag"] = response.headers.get("ETag")
+        estado_planilha["last_modified"] = response.headers.get("Last-Modified")
+
+    hash_conteudo = resumo.hexdigest()
+    if hash_conteudo == estado_planilha["hash"]:
+        estatisticas.update(status="inalterada", linhas_lidas=0)
+        planilha_pronta.set()
+        await salvar_snapshot({}, [])
+        print("✅ Planilha baixada, mas o conteúdo não mudou.")
+        return estatisticas
+
+    removidas = [chave for chave in indice_atual.por_chat_id if chave not in vistas]
+    if len(alteradas) + len(removidas) > LIMITE_DIFF_NO_LOOP:
+        # Carga inicial ou troca grande da planilha: monta o índice fora do event loop
+        publicar_indice(await asyncio.to_thread(indice_atual.aplicar_diff, alteradas, removidas))
+    elif alteradas or removidas:
+        publicar_indice(indice_atual.aplicar_diff(alteradas, removidas))
+    if alteradas or removidas:
+        conferir_regioes_das_rotas()
+    estado_planilha["hash"] = hash_conteudo
+    planilha_pronta.set()
+    await salvar_snapshot(alteradas, removidas)
+
+    estatisticas.update(status="aplicada", linhas_alteradas=len(alteradas), linhas_removidas=len(removidas))
+    print(
+        f"✅ Planilha atualizada com sucesso! ({len(indice_escolas)} cadastros, "
+        f"{len(alteradas)} alterados, {len(removidas)} removidos, {estatisticas['bytes']} bytes)"
+    )
+    return estatisticas
+
+async def carregar_rotas_csv(sessao):
+    """
+    Baixa a planilha de rotas (condicional, como a de cadastro) e, se ela mudou,
+    recalcula os destinatários de cada escola. Sem ROTAS_CSV_URL, todo alerta vai
+    apenas para os ADMIN_CHAT_IDS.
+    """
+    if not ROTAS_CSV_URL:
+        return False
+    cabecalhos = {}
+    if estado_rotas["etag"]:
+        cabecalhos["If-None-Match"] = estado_rotas["etag"]
+    if estado_rotas["last_modified"]:
+        cabecalhos["If-Modified-Since"] = estado_rotas["last_modified"]
+
+    async with sessao.get(ROTAS_CSV_URL, headers=cabecalhos) as response:
+        if response.status == 304:
+            return False
+        response.raise_for_status()
+        leitor = LeitorCsvIncremental()
+        linhas = leitor.alimentar(await response.read()) + leitor.finalizar()
+        estado_rotas["etag"] = response.headers.get("ETag")
+        estado_rotas["last_modified"] = response.headers.get("Last-Modified")
+
+    nova_tabela = TabelaRotas(linhas)
+    if nova_tabela == tabela_rotas:
+        return False
+    definir_rotas(nova_tabela)
+    publicar_indice(indice_escolas.com_rotas())
+    conferir_regioes_das_rotas()
+    await salvar_snapshot({}, [])
+    print(
+        f"✅ Rotas de alerta atualizadas ({len(nova_tabela.por_regiao)} regiões, "
+        f"{len(nova_tabela.por_escola)} escolas com equipes próprias)"
+    )
+    return True
+
+async def salvar_snapshot(alteradas, removidas):
+    """ Grava a atualização no snapshot local sem bloquear o event loop """
+    metadados = dict(estado_planilha, rotas=json.dumps(tabela_rotas.linhas, ensure_ascii=False))
+    try:
+        await asyncio.to_thread(snapshot_planilha.gravar, alteradas, removidas, metadados)
+    except sqlite3.Error as e:
+        print(f"❌ Erro ao gravar o snapshot local da planilha: {e}")
 
 def buscar_dados_escola(chat_id):
+    inicio = time.perf_counter()
     try:
-        for linha in dados_planilha:
-            if str(linha['Chat ID']) == str(chat_id):
-                return linha
-        return None
+        return indice_escolas.buscar(chat_id)
     except Exception as e:
         print(f"❌ Erro ao buscar dados: {e}")
+    finally:
+        metricas.observar("guardiao_etapa_ms", (time.perf_counter() - inicio) * 1000, etapa="busca_cadastro")
 
-def exibir_erro(mensagem):
+# Usado quando a planilha ainda não carregou: o alerta segue, marcado como não verificado
+DADOS_NAO_VERIFICADOS = MappingProxyType({
+    'Escola': "⚠️ NÃO VERIFICADA (planilha indisponível)",
+    'Nome': "—", 'Função': "—", 'Telefone': "—", 'Email': "—", 'Endereço': "—", 'Localização': "—",
+})
+
+async def obter_dados_escola(chat_id):
+    """
+    Busca o cadastro esperando (até TEMPO_ESPERA_PLANILHA) a planilha ficar pronta.
+    Se ela não carregar a tempo, retorna DADOS_NAO_VERIFICADOS em vez de tratar
+    o remetente como não cadastrado, para que nenhum alerta seja recusado no boot.
+    """
+    dados = buscar_dados_escola(chat_id)
+    if dados is not None or planilha_pronta.is_set():
+        return dados
+    try:
+        await asyncio.wait_for(planilha_pronta.wait(), TEMPO_ESPERA_PLANILHA)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Planilha ainda indisponível; mensagem de {chat_id} tratada como não verificada")
+        return DADOS_NAO_VERIFICADOS
+    return buscar_dados_escola(chat_id)
+
+def destinatarios_da_escola(dados_escola):
+    """ Quem recebe os alertas desta escola (calculado uma vez por índice) """
+    destinatarios = indice_escolas.destinatarios_de(chave_da_linha(dados_escola))
+    return destinatarios if destinatarios is not None else tuple(ADMIN_CHAT_IDS)
+
+def coordenadas_da_escola(dados_escola):
+    """ (lat, lon) da coluna Localização, interpretada uma vez por índice """
+    chave = chave_da_linha(dados_escola)
+    if chave in indice_escolas.por_chat_id:
+        return indice_escolas.coordenadas_de(chave)
+    return extrair_coordenadas(dados_escola.get('Localização'))
+
+def cabecalho_da_escola(dados_escola):
+    cabecalho = indice_escolas.cabecalho(chave_da_linha(dados_escola))
+    return cabecalho if cabecalho is not None else renderizar_cabecalho_escola(dados_escola)
+
+def renderizar_unidades(unidades):
+    if not unidades:
+        return ""
+    linhas = [f"- {escapar_markdown(nome)}: {distancia:.1f} km" for distancia, _, nome in unidades]
+    return "\n🚓 *Unidades mais próximas (acionadas primeiro)*:\n" + "\n".join(linhas) + "\n"
+
+def renderizar_alerta(dados_escola, tipo, detalhes=None, usuario=None, chat_id=None, tipo_mensagem="livre", outras=(), unidades=()):
+    """
+    Monta o alerta de emergência para os administradores.
+    O bloco da escola vem pronto do índice; aqui só entram o tipo, a mensagem e o usuário (escapados).
+    """
+    tipo_formatado = escapar_markdown(tipo.upper())
+    if outras:
+        tipo_formatado += f" (também: {escapar_markdown(', '.join(outras))})"
+
+    # Verifica o tipo de mensagem e ajusta o conteúdo exibido
+    if tipo_mensagem == "comando":
+        corpo = (
+            f"⚠️ *Usuário acionou o botão de emergência: {escapar_markdown(tipo.upper())}*.\n"
+            f"O solicitante pode estar em perigo. Prossiga com brevidade e cautela.⚠️\n"
+        )
+    else:
+        corpo = (
+            f"📩 *Mensagem original*: \"{escapar_markdown((detalhes or '').upper())}\"\n"
+            f"Usuário pode estar em perigo. Prossiga com brevidade e cautela.⚠️\n"
+        )
+
+    if usuario is not None:
+        corpo += (
+            f"👤 *Usuário*: @{escapar_markdown(usuario.username or 'Sem username')} "
+            f"(Nome: {escapar_markdown(usuario.first_name)}, Chat ID: {chat_id})\n"
+        )
+
+    return "".join((
+        "🚨 *ALERTA DE EMERGÊNCIA* 🚨\n\n",
+        f"🔔 *Tipo de Emergência*: {tipo_formatado}\n",
+        cabecalho_da_escola(dados_escola),
+        "\n",
+        corpo,
+        renderizar_unidades(unidades),
+        "\n🆘 *Atenção*: Contatar imediatamente o solicitante!",
+    ))
+
+# 🔹 Histograma de latências com faixas fixas (em milissegundos)
+class Histograma:
+    FAIXAS_PADRAO = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    FAIXAS_RAPIDAS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50)  # Etapas internas (sub-milissegundo)
+
+    def __init__(self, faixas=FAIXAS_PADRAO):
+        self.faixas = tuple(faixas)
+        self.contagens = [0] * (len(self.faixas) + 1)  # A última faixa é "+Inf"
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.contagens[bisect.bisect_left(self.faixas, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def percentil(self, p):
+        """ Estimativa pelo limite superior da faixa onde cai o percentil p (0-100) """
+        if not self.total:
+            return 0.0
+        alvo = self.total * p / 100
+        acumulado = 0
+        for limite, contagem in zip(self.faixas + (float("inf"),), self.contagens):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return limite
+        return float("inf")
+
+# 🔹 Métricas em memória (contadores e histogramas), exportadas no formato do Prometheus
+class Metricas:
+    """
+    Registro leve de contadores e histogramas, pensado para ficar sempre ligado:
+    cada observação é só um incremento em dict e um bisect.
+    """
+
+    def __init__(self):
+        self.contadores = collections.Counter()  # (nome, rótulos) -> valor
+        self.histogramas = {}  # (nome, rótulos) -> Histograma
+        self.faixas = {}  # nome -> faixas do histograma
+        self.ajuda = {}
+        self.iniciado_em = time.time()
+
+    def registrar(self, nome, ajuda, faixas=None):
+        self.ajuda[nome] = ajuda
+        if faixas is not None:
+            self.faixas[nome] = faixas
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        self.contadores[(nome, tuple(sorted(rotulos.items())))] += valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        histograma = self.histogramas.get(chave)
+        if histograma is None:
+            histograma = self.histogramas[chave] = Histograma(self.faixas.get(nome, Histograma.FAIXAS_PADRAO))
+        histograma.observar(valor)
+
+    def agregado(self, nome):
+        """ Soma os histogramas de uma métrica em todos os rótulos """
+        total = Histograma(self.faixas.get(nome, Histograma.FAIXAS_PADRAO))
+        for (nome_histograma, _), histograma in self.histogramas.items():
+            if nome_histograma == nome:
+                total.contagens = [a + b for a, b in zip(total.contagens, histograma.contagens)]
+                total.soma += histograma.soma
+                total.total += histograma.total
+        return total
+
+    def soma(self, nome, **filtro):
+        """ Soma um contador em todos os rótulos que contenham os pares de `filtro` """
+        pares = set(filtro.items())
+        return sum(valor for (nome_contador, rotulos), valor in self.contadores.items()
+                   if nome_contador == nome and pares <= set(rotulos))
+
+    @staticmethod
+    def _rotulos(rotulos, extra=()):
+        pares = list(rotulos) + list(extra)
+        if not pares:
+            return ""
+        return "{" + ",".join(f'{chave}="{str(valor).replace(chr(34), chr(39))}"' for chave, valor in pares) + "}"
+
+    def exportar(self, medidores=()):
+        """ Texto no formato de exposição do Prometheus; `medidores` são (nome, tipo, rótulos, valor) calculados na hora """
+        linhas = []
+        tipos_emitidos = set()
+
+        def cabecalho(nome, tipo):
+            if nome not in tipos_emitidos:
+                tipos_emitidos.add(nome)
+                if nome in self.ajuda:
+                    linhas.append(f"# HELP {nome} {self.ajuda[nome]}")
+                linhas.append(f"# TYPE {nome} {tipo}")
+
+        for (nome, rotulos), valor in sorted(self.contadores.items()):
+            cabecalho(nome, "counter")
+            linhas.append(f"{nome}{self._rotulos(rotulos)} {valor}")
+
+        for (nome, rotulos), histograma in sorted(self.histogramas.items(), key=lambda item: item[0]):
+            cabecalho(nome, "histogram")
+            acumulado = 0
+            for limite, contagem in zip(histograma.faixas + ("+Inf",), histograma.contagens):
+                acumulado += contagem
+                linhas.append(f"{nome}_bucket{self._rotulos(rotulos, [('le', limite)])} {acumulado}")
+            linhas.append(f"{nome}_sum{self._rotulos(rotulos)} {histograma.soma}")
+            linhas.append(f"{nome}_count{self._rotulos(rotulos)} {histograma.total}")
+
+        for nome, tipo, rotulos, valor in sorted(medidores, key=lambda medidor: medidor[0]):  # Famílias contíguas
+            cabecalho(nome, tipo)
+            linhas.append(f"{nome}{self._rotulos(sorted(rotulos.items()))} {valor}")
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+metricas.registrar("guardiao_etapa_ms", "Duração de cada etapa do processamento de alertas", Histograma.FAIXAS_RAPIDAS)
+metricas.registrar("guardiao_handler_ms", "Duração total dos handlers de mensagens")
+metricas.registrar("guardiao_envio_ms", "Duração de cada chamada de envio à API do Telegram")
+metricas.registrar("guardiao_alerta_ponta_a_ponta_ms", "Do recebimento do update à última entrega aos administradores")
+metricas.registrar("guardiao_alertas_total", "Alertas de emergência recebidos, por tipo")
+metricas.registrar("guardiao_envios_total", "Envios à API do Telegram, por método e resultado")
+metricas.registrar("guardiao_usuarios_desconhecidos_total", "Mensagens de chats não cadastrados")
+metricas.registrar("guardiao_pedidos_cadastro_total", "Comandos /cadastro recebidos")
+metricas.registrar("guardiao_midias_repassadas_total", "Fotos, áudios, vídeos e localizações repassados aos incidentes, por tipo")
+metricas.registrar("guardiao_localizacoes_suprimidas_total", "Atualizações de localização em tempo real não repassadas (limite de frequência)")
+
+# 🔹 Limites de envio do Telegram (mensagens por segundo)
+LIMITE_GLOBAL_POR_SEGUNDO = float(os.getenv("LIMITE_GLOBAL_POR_SEGUNDO", "30"))
+LIMITE_POR_CHAT_POR_SEGUNDO = float(os.getenv("LIMITE_POR_CHAT_POR_SEGUNDO", "1"))
+RAJADA_POR_CHAT = int(os.getenv("RAJADA_POR_CHAT", "3"))
+MAXIMO_BALDES_POR_CHAT = int(os.getenv("MAXIMO_BALDES_POR_CHAT", "1000"))  # chats com limite em memória (LRU)
+TENTATIVAS_ENVIO = int(os.getenv("TENTATIVAS_ENVIO", "5"))
+BACKOFF_INICIAL_ENVIO = float(os.getenv("BACKOFF_INICIAL_ENVIO", "0.5"))  # segundos
+
+class BaldeDeTokens:
+    """ Token bucket assíncrono: libera até `taxa` envios por segundo, com rajadas de até `capacidade` """
+
+    def __init__(self, taxa, capacidade=1):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.tokens = float(capacidade)
+        self.atualizado_em = time.monotonic()
+
+    def _reabastecer(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado_em) * self.taxa)
+        self.atualizado_em = agora
+
+    async def consumir(self):
+        while True:
+            self._reabastecer()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.taxa)
+
+    def tentar_consumir(self):
+        """ Consome um token se houver; nunca espera """
+        self._reabastecer()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+balde_global = BaldeDeTokens(LIMITE_GLOBAL_POR_SEGUNDO, LIMITE_GLOBAL_POR_SEGUNDO)
+baldes_por_chat = collections.OrderedDict()  # chat_id -> balde, do menos para o mais recente
+
+def balde_do_chat(chat_id):
+    balde = baldes_por_chat.get(chat_id)
+    if balde is None:
+        balde = baldes_por_chat[chat_id] = BaldeDeTokens(LIMITE_POR_CHAT_POR_SEGUNDO, RAJADA_POR_CHAT)
+        if len(baldes_por_chat) > MAXIMO_BALDES_POR_CHAT:
+            baldes_por_chat.popitem(last=False)  # O menos recente já está com o balde cheio há tempos
+    else:
+        baldes_por_chat.move_to_end(chat_id)
+    return balde
+
+async def enviar_com_limite(bot, metodo, chat_id, **kwargs):
+    """
+    Envia uma única chamada à API respeitando os limites global e por chat.
+    Respeita RetryAfter e tenta novamente com backoff exponencial em falhas de rede.
+    Retorna o status da entrega para o destinatário.
+    """
+    resultado = {"status": "falhou", "tentativas": 0, "erro": None, "mensagem": None}
+    for tentativa in range(1, TENTATIVAS_ENVIO + 1):
+        resultado["tentativas"] = tentativa
+        await balde_do_chat(chat_id).consumir()
+        await balde_global.consumir()
+        inicio = time.perf_counter()
+        try:
+            resultado["mensagem"] = await getattr(bot, metodo)(chat_id=chat_id, **kwargs)
+            resultado["status"] = "entregue"
+            resultado["erro"] = None
+            return resultado
+        except RetryAfter as e:
+            resultado["erro"] = str(e)
+            espera = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            print(f"⏳ Limite do Telegram atingido para {chat_id}, aguardando {espera}s")
+            await asyncio.sleep(espera)
+        except (BadRequest, Forbidden) as e:
+            resultado["status"] = "recusado"  # Erros permanentes: não adianta tentar de novo
+            resultado["erro"] = str(e)
+            return resultado
+        except NetworkError as e:
+            resultado["erro"] = str(e)
+            await asyncio.sleep(BACKOFF_INICIAL_ENVIO * 2 ** (tentativa - 1) * random.uniform(0.8, 1.2))
+        finally:
+            metricas.observar("guardiao_envio_ms", (time.perf_counter() - inicio) * 1000, metodo=metodo)
+            metricas.incrementar("guardiao_envios_total", metodo=metodo, resultado=resultado["status"] if resultado["erro"] is None else "erro")
+    return resultado
+
+# 🔹 Fila de prioridade na frente de todo o tráfego para os administradores
+PRIORIDADE_EMERGENCIA = 0
+PRIORIDADE_TESTE = 1
+PRIORIDADE_CADASTRO = 2
+PRIORIDADE_DIAGNOSTICO = 3
+NOMES_PRIORIDADES = {
+    PRIORIDADE_EMERGENCIA: "emergencia",
+    PRIORIDADE_TESTE: "teste",
+    PRIORIDADE_CADASTRO: "cadastro",
+    PRIORIDADE_DIAGNOSTICO: "diagnostico",
+}
+TRABALHADORES_ENVIO = int(os.getenv("TRABALHADORES_ENVIO", "8"))
+TAMANHO_MAXIMO_FILA = int(os.getenv("TAMANHO_MAXIMO_FILA", "1000"))
+
+def prioridade_do_tipo(tipo):
+    return PRIORIDADE_TESTE if tipo.lower() == "teste" else PRIORIDADE_EMERGENCIA
+
+class DespachanteDeEnvios:
+    """
+    Fila em memória, uma por classe de prioridade, consumida por um número fixo de trabalhadores.
+    Emergências sempre saem primeiro; com a fila cheia, descarta-se a classe menos importante.
+    """
+
+    def __init__(self, trabalhadores, tamanho_maximo):
+        self.quantidade_trabalhadores = trabalhadores
+        self.tamanho_maximo = tamanho_maximo
+        self.filas = {prioridade: collections.deque() for prioridade in NOMES_PRIORIDADES}
+        self.trabalhadores = []
+        self.disponivel = None
+        self.liberado = None  # Fechado durante quedas de conexão: os envios ficam retidos na fila
+        self.estatisticas = {
+            prioridade: {"enfileirados": 0, "enviados": 0, "descartados": 0, "espera_total": 0.0, "espera_maxima": 0.0}
+            for prioridade in NOMES_PRIORIDADES
+        }
+
+    def __len__(self):
+        return sum(len(fila) for fila in self.filas.values())
+
+    def _iniciar(self):
+        if self.disponivel is None:
+            self.disponivel = asyncio.Condition()
+        if self.liberado is None:
+            self.liberado = asyncio.Event()
+            self.liberado.set()
+        self.trabalhadores = [t for t in self.trabalhadores if not t.done()]
+        while len(self.trabalhadores) < self.quantidade_trabalhadores:
+            self.trabalhadores.append(asyncio.create_task(self._trabalhar()))
+
+    def reter(self):
+        """ Segura os envios na fila (ex.: sem conexão com o Telegram) """
+        self._iniciar()
+        self.liberado.clear()
+
+    def liberar(self):
+        """ Volta a enviar, começando pelo que ficou retido na fila """
+        self._iniciar()
+        self.liberado.set()
+
+    async def parar(self):
+        for trabalhador in self.trabalhadores:
+            trabalhador.cancel()
+        await asyncio.gather(*self.trabalhadores, return_exceptions=True)
+        self.trabalhadores = []
+
+    def _descartar(self, tarefa):
+        prioridade, _, chat_id, _, futuro = tarefa
+        self.estatisticas[prioridade]["descartados"] += 1
+        if not futuro.done():
+            futuro.set_result({"status": "descartado", "tentativas": 0, "erro": "fila cheia", "mensagem": None})
+        print(f"🗑️ Fila de envio cheia: descartado envio ({NOMES_PRIORIDADES[prioridade]}) para {chat_id}")
+
+    async def enfileirar(self, prioridade, bot, metodo, chat_id, kwargs):
+        """ Enfileira um envio e retorna um future com o status da entrega """
+        self._iniciar()
+        futuro = asyncio.get_running_loop().create_future()
+        tarefa = (prioridade, time.monotonic(), chat_id, (bot, metodo, kwargs), futuro)
+        self.estatisticas[prioridade]["enfileirados"] += 1
+
+        if len(self) >= self.tamanho_maximo:
+            menos_importante = max(p for p, fila in self.filas.items() if fila)
+            if menos_importante <= prioridade:
+                self._descartar(tarefa)
+                return futuro
+            self._descartar(self.filas[menos_importante].pop())  # Descarta o mais recente da classe menos importante
+
+        self.filas[prioridade].append(tarefa)
+        async with self.disponivel:
+            self.disponivel.notify()
+        return futuro
+
+    async def _proxima(self):
+        while True:
+            await self.liberado.wait()
+            async with self.disponivel:
+                while not len(self) and self.liberado.is_set():
+                    await self.disponivel.wait()
+                # Um trabalhador ocioso já passou do liberado.wait(); se houve reter() enquanto
+                # ele esperava a fila, o envio continua retido até o liberar()
+                if not self.liberado.is_set():
+                    continue
+                for prioridade in sorted(self.filas):
+                    if self.filas[prioridade]:
+                        return self.filas[prioridade].popleft()
+
+    async def _trabalhar(self):
+        while True:
+            prioridade, enfileirado_em, chat_id, (bot, metodo, kwargs), futuro = await self._proxima()
+            espera = time.monotonic() - enfileirado_em
+            estatisticas = self.estatisticas[prioridade]
+            estatisticas["espera_total"] += espera
+            estatisticas["espera_maxima"] = max(estatisticas["espera_maxima"], espera)
+            try:
+                resultado = await enviar_com_limite(bot, metodo, chat_id, **kwargs)
+            except Exception as e:
+                resultado = {"status": "falhou", "tentativas": 1, "erro": str(e), "mensagem": None}
+            estatisticas["enviados"] += 1
+            if not futuro.done():
+                futuro.set_result(resultado)
+
+    def metricas(self):
+        """ Profundidade da fila e tempos de espera por classe de prioridade """
+        metricas = {}
+        for prioridade, nome in NOMES_PRIORIDADES.items():
+            estatisticas = self.estatisticas[prioridade]
+            metricas[nome] = {
+                "profundidade": len(self.filas[prioridade]),
+                "enfileirados": estatisticas["enfileirados"],
+                "enviados": estatisticas["enviados"],
+                "descartados": estatisticas["descartados"],
+                "espera_media": estatisticas["espera_total"] / estatisticas["enviados"] if estatisticas["enviados"] else 0.0,
+                "espera_maxima": estatisticas["espera_maxima"],
+            }
+        return metricas
+
+despachante = DespachanteDeEnvios(TRABALHADORES_ENVIO, TAMANHO_MAXIMO_FILA)
+
+# 🔹 Caixa de saída durável: todo alerta é gravado em disco antes de sair
+TAMANHO_MAXIMO_CAIXA_SAIDA = 1024 * 1024  # bytes; acima disso o arquivo é zerado quando nada estiver pendente
+
+class CaixaDeSaida:
+    """
+    Log append-only (JSON por linha) dos alertas enviados aos administradores.
+    Cada envio é gravado ("envio") antes de entrar na fila e cada destinatário
+    atendido recebe uma marca ("concluido"). As gravações que chegam enquanto um
+    fsync está em andamento vão juntas no próximo (group commit), então o disco
+    não vira gargalo numa rajada de alertas. O que ficou sem marca é reenviado no
+    boot e, com o processo rodando, quando o envio falhou (ex.: sem rede no meio do
+    fan-out): entrega pelo menos uma vez, sem repetir quem já recebeu.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.pendentes = {}  # chave de idempotência -> registro do envio com os destinatários que faltam
+        self.em_andamento = set()  # chaves com envio na fila agora: não são reenviadas até terminar
+        self.lote = []  # linhas aguardando o próximo fsync
+        self.aguardando = []  # futuros liberados quando o lote estiver em disco
+        self.gravacao = None
+        self.arquivo = None
+        self.tamanho = 0
+        self.fsyncs = 0
+        self.registros_gravados = 0
+
+    def abrir(self):
+        """ Lê o log, remonta os envios pendentes e reescreve o arquivo só com eles """
+        self.pendentes = {}
+        if os.path.exists(self.caminho):
+            with open(self.caminho, encoding="utf-8") as arquivo:
+                for linha in arquivo:
+                    try:
+                        registro = json.loads(linha)
+                    except ValueError:
+                        continue  # Última linha cortada por uma queda no meio da gravação
+                    self._aplicar(registro)
+
+        temporario = self.caminho + ".tmp"
+        with open(temporario, "w", encoding="utf-8") as arquivo:
+            for registro in self.pendentes.values():
+                arquivo.write(json.dumps(dict(registro, destinatarios=sorted(registro["destinatarios"])), ensure_ascii=False) + "\n")
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        os.replace(temporario, self.caminho)
+        self.arquivo = open(self.caminho, "a", encoding="utf-8")
+        self.tamanho = self.arquivo.tell()
+        return list(self.pendentes.values())
+
+    def _aplicar(self, registro):
+        if registro.get("op") == "envio":
+            self.pendentes[registro["chave"]] = dict(registro, destinatarios=set(registro["destinatarios"]))
+        elif registro.get("op") == "concluido":
+            envio = self.pendentes.get(registro["chave"])
+            if envio is not None:
+                envio["destinatarios"].discard(registro["destinatario"])
+                if not envio["destinatarios"]:
+                    del self.pendentes[registro["chave"]]
+
+    async def registrar(self, metodo, destinatarios, prioridade, kwargs):
+        """ Grava o envio (só os parâmetros serializáveis) e retorna a chave de idempotência quando estiver em disco """
+        registro = {
+            "op": "envio",
+            "chave": f"{int(time.time())}-{secrets.token_hex(6)}",
+            "criado_em": time.time(),
+            "metodo": metodo,
+            "prioridade": prioridade,
+            "destinatarios": list(destinatarios),
+            "kwargs": {k: v for k, v in kwargs.items() if isinstance(v, (str, int, float, bool))},
+        }
+        self._aplicar(registro)
+        await self._anexar(registro)
+        return registro["chave"]
+
+    def concluir(self, chave, destinatario):
+        """ Marca o destinatário como atendido; não precisa esperar o fsync (no pior caso, ele recebe de novo) """
+        envio = self.pendentes.get(chave)
+        if envio is None or destinatario not in envio["destinatarios"]:
+            return
+        registro = {"op": "concluido", "chave": chave, "destinatario": destinatario}
+        self._aplicar(registro)
+        self._anexar(registro)
+
+    def _anexar(self, registro):
+        """ Coloca o registro no próximo lote e retorna um future liberado quando ele estiver em disco """
+        self.lote.append(json.dumps(registro, ensure_ascii=False) + "\n")
+        futuro = asyncio.get_running_loop().create_future()
+        self.aguardando.append(futuro)
+        if self.gravacao is None or self.gravacao.done():
+            self.gravacao = asyncio.create_task(self._descarregar())
+        return futuro
+
+    async def _descarregar(self):
+        while self.lote:
+            lote, self.lote = self.lote, []
+            aguardando, self.aguardando = self.aguardando, []
+            zerar = not self.pendentes and self.tamanho > TAMANHO_MAXIMO_CAIXA_SAIDA
+            try:
+                await asyncio.to_thread(self._gravar, lote, zerar)
+            except OSError as e:
+                print(f"❌ Erro ao gravar a caixa de saída: {e}")  # O alerta sai mesmo assim
+            for futuro in aguardando:
+                if not futuro.done():
+                    futuro.set_result(None)
+
+    def _gravar(self, lote, zerar):
+        if self.arquivo is None:
+            self.arquivo = open(self.caminho, "a", encoding="utf-8")
+            self.tamanho = self.arquivo.tell()
+        self.arquivo.write("".join(lote))
+        self.arquivo.flush()
+        if zerar:
+            self.arquivo.truncate(0)  # Nada pendente: o histórico do log não é mais necessário
+            self.arquivo.seek(0)
+        os.fsync(self.arquivo.fileno())
+        self.tamanho = self.arquivo.tell()
+        self.fsyncs += 1
+        self.registros_gravados += len(lote)
+
+    def fechar(self):
+        if self.arquivo is not None:
+            self.arquivo.close()
+            self.arquivo = None
+
+caixa_saida = CaixaDeSaida(ARQUIVO_CAIXA_SAIDA)
+
+async def reenviar_pendentes(bot, pendentes, motivo="o Guardião reiniciou antes de confirmar este alerta"):
+    """ Reenvia os alertas que não chegaram a todos os destinatários (no boot ou após uma falha de envio) """
+    envios = []
+    for envio in sorted(pendentes, key=lambda e: (e["prioridade"], e["criado_em"])):
+        if envio["chave"] in caixa_saida.em_andamento or not envio["destinatarios"]:
+            continue
+        kwargs = dict(envio["kwargs"])
+        if "text" in kwargs:
+            aviso = f"♻️ *Reenvio* ({motivo}, de {time.strftime('%d/%m %H:%M:%S', time.localtime(envio['criado_em']))})\n\n"
+            kwargs["text"] = (aviso + kwargs["text"])[:LIMITE_TEXTO_TELEGRAM]
+        print(f"♻️ Reenviando alerta {envio['chave']} para {len(envio['destinatarios'])} destinatário(s)")
+        envios.append(enviar_para_admins(
+            bot, envio["metodo"], sorted(envio["destinatarios"]), envio["prioridade"],
+            chave_idempotencia=envio["chave"], **kwargs,
+        ))
+    await asyncio.gather(*envios)
+
+async def reenviar_falhas(bot):
+    """ Reenvia o que está na caixa de saída sem envio em andamento: destinatários que falharam ou foram descartados """
+    await reenviar_pendentes(bot, list(caixa_saida.pendentes.values()), motivo="a primeira tentativa de entrega falhou")
+
+async def reenviar_falhas_periodicamente(bot):
+    """ A cada INTERVALO_REENVIO_PENDENTES, tenta de novo os envios que falharam (durante uma queda, espera a reconexão) """
+    while True:
+        await asyncio.sleep(INTERVALO_REENVIO_PENDENTES)
+        if monitor_conexao is not None and not monitor_conexao.conectado:
+            continue
+        await reenviar_falhas(bot)
+
+async def enviar_para_admins(bot, metodo="send_message", destinatarios=None, prioridade=PRIORIDADE_DIAGNOSTICO, duravel=False, chave_idempotencia=None, **kwargs):
+    """
+    Envia a mesma chamada para todos os destinatários em paralelo, através da fila de prioridade.
+    Com `duravel`, o envio é gravado na caixa de saída antes de sair e cada entrega é marcada,
+    para ser retomado após um reinício (`chave_idempotencia` identifica um envio já gravado).
+    Retorna um dict {chat_id: status} com o resultado de cada entrega.
+    """
+    envio = await enfileirar_para_admins(bot, metodo, destinatarios, prioridade, duravel, chave_idempotencia, **kwargs)
+    return await aguardar_envio(envio)
+
+async def enfileirar_para_admins(bot, metodo="send_message", destinatarios=None, prioridade=PRIORIDADE_DIAGNOSTICO, duravel=False, chave_idempotencia=None, **kwargs):
+    """ Primeira metade do enviar_para_admins: grava (se durável) e enfileira; o envio já está na fila ao retornar """
+    destinatarios = ADMIN_CHAT_IDS if destinatarios is None else destinatarios
+    if duravel and chave_idempotencia is None and destinatarios:
+        chave_idempotencia = await caixa_saida.registrar(metodo, destinatarios, prioridade, kwargs)
+    if chave_idempotencia is not None:
+        caixa_saida.em_andamento.add(chave_idempotencia)
+    try:
+        futuros = [await despachante.enfileirar(prioridade, bot, metodo, admin_id, kwargs) for admin_id in destinatarios]
+    except BaseException:
+        caixa_saida.em_andamento.discard(chave_idempotencia)
+        raise
+    return {"metodo": metodo, "destinatarios": destinatarios, "chave": chave_idempotencia, "futuros": futuros}
+
+async def aguardar_envio(envio):
+    """ Segunda metade do enviar_para_admins: espera as entregas e marca na caixa de saída quem foi atendido """
+    metodo, chave_idempotencia = envio["metodo"], envio["chave"]
+    try:
+        resultados = await asyncio.gather(*envio["futuros"])
+    finally:
+        caixa_saida.em_andamento.discard(chave_idempotencia)
+    status = dict(zip(envio["destinatarios"], resultados))
+    for admin_id, resultado in status.items():
+        if chave_idempotencia is not None and resultado["status"] in ("entregue", "recusado"):
+            caixa_saida.concluir(chave_idempotencia, admin_id)
+        if resultado["status"] == "entregue":
+            print(f"✅ Envio ({metodo}) entregue para {admin_id}")
+        else:
+            print(f"❌ Falha ao enviar ({metodo}) para {admin_id} após {resultado['tentativas']} tentativa(s): {resultado['erro']}")
+    return status
+
+async def exibir_erro(bot, mensagem):
     """ Registra erros no log e notifica os administradores """
     print(f"❌ ERRO: {mensagem}")  # Exibe o erro no console
+    await enviar_para_admins(bot, prioridade=PRIORIDADE_DIAGNOSTICO, text=f"⚠️ Erro detectado: {mensagem}")
+
+# 🔹 Histórico de incidentes (SQLite, só inserções), gravado fora do caminho do alerta
+COLUNAS_HISTORICO = (
+    "incidente", "aberto_em", "escola", "regiao", "tipo", "aberto_por", "mensagem",
+    "atualizacoes", "reconhecido_por", "reconhecido_em", "encerrado_por", "encerrado_em",
+)
+
+class HistoricoIncidentes:
+    """
+    Log append-only dos eventos de cada incidente (aberto, atualização, reconhecido, encerrado).
+    Os eventos vão para um lote em memória e são gravados em uma única transação por uma
+    tarefa à parte, sem atrasar o envio do alerta. Os índices por escola e por horário
+    mantêm as consultas rápidas sem carregar o log em memória.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.lote = []
+        self.gravacao = None
+        self.eventos_gravados = 0
+
+    def _conectar(self):
+        conexao = sqlite3.connect(self.caminho)
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute(
+            "CREATE TABLE IF NOT EXISTS eventos (incidente INTEGER NOT NULL, evento TEXT NOT NULL, instante REAL NOT NULL, "
+            "escola_chave TEXT, escola TEXT, regiao TEXT, tipo TEXT, autor TEXT, detalhe TEXT)"
+        )
+        # Escola, região e tipo só vão no evento "aberto"; os índices parciais cobrem só esses eventos
+        conexao.execute("CREATE INDEX IF NOT EXISTS abertos_por_escola ON eventos (escola_chave, instante) WHERE evento = 'aberto'")
+        conexao.execute("CREATE INDEX IF NOT EXISTS abertos_por_instante ON eventos (instante) WHERE evento = 'aberto'")
+        conexao.execute("CREATE INDEX IF NOT EXISTS eventos_por_incidente ON eventos (incidente, evento)")
+        return conexao
+
+    def registrar(self, incidente, evento, autor=None, detalhe=None, instante=None):
+        """ Enfileira um evento; não bloqueia nem espera o disco """
+        escola = (None, None, None, None)
+        if evento == "aberto":
+            escola = (incidente.chave, incidente.dados_escola.get('Escola'), incidente.dados_escola.get('Região'), incidente.tipo)
+        self.lote.append((
+            incidente.chave_historico, evento, instante or time.time(), *escola,
+            None if autor is None else str(autor), detalhe,
+        ))
+        if self.gravacao is None or self.gravacao.done():
+            self.gravacao = asyncio.create_task(self._descarregar())
+
+    async def _descarregar(self):
+        while self.lote:
+            lote, self.lote = self.lote, []
+            try:
+                await asyncio.to_thread(self._gravar, lote)
+            except sqlite3.Error as e:
+                print(f"❌ Erro ao gravar o histórico de incidentes ({len(lote)} eventos perdidos): {e}")
+
+    def _gravar(self, lote):
+        with closing(self._conectar()) as conexao, conexao:
+            conexao.executemany("INSERT INTO eventos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", lote)
+        self.eventos_gravados += len(lote)
+
+    def encerrar_pendentes(self, autor):
+        """ Grava "encerrado" para os incidentes que ficaram abertos no log (ex.: perdidos em um reinício) """
+        if not os.path.exists(self.caminho):
+            return 0
+        with closing(self._conectar()) as conexao, conexao:
+            cursor = conexao.execute(
+                "INSERT INTO eventos (incidente, evento, instante, autor) "
+                "SELECT a.incidente, 'encerrado', ?, ? FROM eventos a WHERE a.evento = 'aberto' "
+                "AND NOT EXISTS (SELECT 1 FROM eventos e WHERE e.incidente = a.incidente AND e.evento = 'encerrado')",
+                (time.time(), autor),
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def _filtros(escola, inicio, fim):
+        condicoes, parametros = ["evento = 'aberto'"], []
+        # Com escola, o índice por escola é sempre o mais seletivo: o "+" impede o SQLite de usar o de horário
+        instante = "+instante" if escola else "instante"
+        if escola:
+            # Prefixo da chave normalizada: "/historico caic" encontra "CAIC Unesco"
+            condicoes.append("escola_chave >= ? AND escola_chave < ?")
+            parametros += [escola, escola + "\uffff"]
+        if inicio is not None:
+            condicoes.append(f"{instante} >= ?")
+            parametros.append(inicio)
+        if fim is not None:
+            condicoes.append(f"{instante} < ?")
+            parametros.append(fim)
+        return " AND ".join(condicoes), parametros
+
+    def consultar(self, escola=None, inicio=None, fim=None, limite=None):
+        """ Incidentes abertos no período (mais recentes primeiro), um dict por incidente """
+        if not os.path.exists(self.caminho):
+            return
+        condicoes, parametros = self._filtros(escola, inicio, fim)
+        # Filtra e limita primeiro; os demais eventos só são buscados para os incidentes retornados
+        abertos = f"SELECT * FROM eventos WHERE {condicoes} ORDER BY instante DESC"
+        if limite is not None:
+            abertos += " LIMIT ?"
+            parametros.append(limite)
+        sql = (
+            "SELECT a.incidente, a.instante, a.escola, a.regiao, a.tipo, a.autor, a.detalhe, "
+            "(SELECT COUNT(*) FROM eventos e WHERE e.incidente = a.incidente AND e.evento = 'atualizacao'), "
+            "r.autor, r.instante, f.autor, f.instante "
+            f"FROM ({abertos}) a "
+            "LEFT JOIN eventos r ON r.rowid = (SELECT rowid FROM eventos WHERE incidente = a.incidente AND evento = 'reconhecido' LIMIT 1) "
+            "LEFT JOIN eventos f ON f.rowid = (SELECT rowid FROM eventos WHERE incidente = a.incidente AND evento = 'encerrado' LIMIT 1) "
+            "ORDER BY a.instante DESC"
+        )
+        with closing(self._conectar()) as conexao:
+            for linha in conexao.execute(sql, parametros):
+                yield dict(zip(COLUNAS_HISTORICO, linha))
+
+    def contar(self, escola=None, inicio=None, fim=None):
+        if not os.path.exists(self.caminho):
+            return 0
+        condicoes, parametros = self._filtros(escola, inicio, fim)
+        with closing(self._conectar()) as conexao:
+            return conexao.execute(f"SELECT COUNT(*) FROM eventos WHERE {condicoes}", parametros).fetchone()[0]
+
+    def exportar_csv(self, escola=None, inicio=None, fim=None):
+        """ Relatório CSV (UTF-8 com BOM, para abrir direto no Excel) dos incidentes filtrados """
+        saida = io.StringIO()
+        escritor = csv.writer(saida)
+        escritor.writerow(COLUNAS_HISTORICO)
+        datas = ("aberto_em", "reconhecido_em", "encerrado_em")
+        for incidente in self.consultar(escola, inicio, fim):
+            escritor.writerow([
+                time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(incidente[coluna])) if coluna in datas and incidente[coluna] else incidente[coluna]
+                for coluna in COLUNAS_HISTORICO
+            ])
+        return saida.getvalue().encode("utf-8-sig")
+
+historico_incidentes = HistoricoIncidentes(ARQUIVO_HISTORICO)
+
+# 🔹 Incidentes: agrupa as mensagens de uma mesma escola em um único alerta em andamento
+ESTADO_ABERTO = "aberto"
+ESTADO_RECONHECIDO = "reconhecido"
+ESTADO_ENCERRADO = "encerrado"
+LIMITE_TEXTO_TELEGRAM = 4096
+LIMITE_LEGENDA_TELEGRAM = 1024
+
+class Incidente:
+    def __init__(self, identificador, chave, dados_escola, tipo, prioridade, unidades=()):
+        self.identificador = identificador
+        self.chave = chave
+        self.dados_escola = dados_escola
+        self.tipo = tipo
+        self.prioridade = prioridade
+        self.estado = ESTADO_ABERTO
+        self.aberto_em = time.time()
+        self.ultima_atividade = time.monotonic()
+        self.reconhecido_por = None
+        self.mensagens_admin = {}  # admin_id -> message_id do alerta original
+        self.alerta_enviado = asyncio.Event()
+        self.pendentes = []  # atualizações ainda não enviadas
+        self.tarefa_agrupamento = None
+        self.atualizacoes = 0
+        self.unidades = list(unidades)  # [(distância_km, chat_id, nome)] das unidades mais próximas
+        # Fixados na abertura: unidades mais próximas primeiro (saem antes na fila), depois as rotas da escola
+        self.destinatarios = tuple(dict.fromkeys(
+            [chat_id for _, chat_id, _ in self.unidades] + list(destinatarios_da_escola(dados_escola))
+        ))
+        self.localizacoes = {}  # chat_id -> (instante, (lat, lon)) do último repasse de localização em tempo real
+        self.chave_historico = secrets.randbits(62)  # os números (#1, #2...) recomeçam a cada reinício
+
+    def expirado(self):
+        return time.monotonic() - self.ultima_atividade > JANELA_INCIDENTE
+
+class GerenciadorIncidentes:
+    """
+    Mantém um incidente por escola. O primeiro alerta abre o incidente e vai completo para
+    os administradores; as mensagens seguintes dentro da janela são agrupadas e enviadas
+    como uma única resposta ao alerta original, em vez de um novo alerta completo.
+    """
+
+    def __init__(self):
+        self.ativos = {}  # chave da escola -> Incidente
+        self.por_id = {}
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def chave(dados_escola, chat_id):
+        if dados_escola is DADOS_NAO_VERIFICADOS:
+            return f"chat:{chat_id}"  # Sem planilha, não dá para saber quais chats são da mesma escola
+        return normalizar_chave(dados_escola.get('Escola')) or f"chat:{chat_id}"
+
+    def ativo(self, dados_escola, chat_id):
+        """ Retorna o incidente em andamento da escola, encerrando-o se a janela expirou """
+        incidente = self.ativos.get(self.chave(dados_escola, chat_id))
+        if incidente is not None and incidente.expirado():
+            self.encerrar(incidente)
+            return None
+        return incidente
+
+    def encerrar_expirados(self):
+        """ Encerra os incidentes sem novidades há mais de JANELA_INCIDENTE, mesmo que a escola não escreva de novo """
+        expirados = [incidente for incidente in self.ativos.values() if incidente.expirado()]
+        for incidente in expirados:
+            self.encerrar(incidente)
+        return len(expirados)
+
+    def encerrar(self, incidente, autor="expirado"):
+        incidente.estado = ESTADO_ENCERRADO
+        historico_incidentes.registrar(incidente, "encerrado", autor)
+        if self.ativos.get(incidente.chave) is incidente:
+            del self.ativos[incidente.chave]
+        self.por_id.pop(incidente.identificador, None)
+        print(f"🔒 Incidente #{incidente.identificador} encerrado ({incidente.atualizacoes} atualizações)")
+
+    async def registrar(self, bot, dados_escola, tipo, detalhes, usuario, chat_id, tipo_mensagem="livre", outras=(), recebido_em=None):
+        """
+        Registra um alerta. Retorna (incidente, novo), onde `novo` indica se foi aberto um incidente.
+        Um alerta mais urgente que o incidente em andamento (ex.: TESTE seguido de AGRESSOR) abre um novo.
+        """
+        prioridade = prioridade_do_tipo(tipo)
+        metricas.incrementar("guardiao_alertas_total", tipo=normalizar_texto(tipo))
+        incidente = self.ativo(dados_escola, chat_id)
+        if incidente is not None and prioridade >= incidente.prioridade:
+            self.anexar(
+                bot, incidente, renderizar_atualizacao(tipo, detalhes, usuario, chat_id, tipo_mensagem),
+                f"/{normalizar_texto(tipo).lower()}" if tipo_mensagem == "comando" else detalhes,
+            )
+            return incidente, False
+
+        if incidente is not None:
+            self.encerrar(incidente, autor=f"substituído por {tipo}")
+        unidades = unidades_resposta.mais_proximas(coordenadas_da_escola(dados_escola))
+        incidente = Incidente(next(self._ids), self.chave(dados_escola, chat_id), dados_escola, tipo, prioridade, unidades)
+        self.ativos[incidente.chave] = incidente
+        self.por_id[incidente.identificador] = incidente
+        print(f"🚨 Incidente #{incidente.identificador} aberto: {tipo.upper()} para {dados_escola['Escola']}")
+        historico_incidentes.registrar(
+            incidente, "aberto", nome_do_usuario(usuario, chat_id), detalhes or f"/{normalizar_texto(tipo).lower()}",
+            instante=incidente.aberto_em,
+        )
+
+        inicio = time.perf_counter()
+        mensagem = renderizar_alerta(dados_escola, tipo, detalhes, usuario, chat_id, tipo_mensagem, outras, incidente.unidades)
+        metricas.observar("guardiao_etapa_ms", (time.perf_counter() - inicio) * 1000, etapa="renderizacao")
+
+        async def enviar_texto(envio):
+            try:
+                status = await aguardar_envio(envio)
+                incidente.mensagens_admin = {
+                    admin_id: resultado["mensagem"].message_id
+                    for admin_id, resultado in status.items()
+                    if resultado["mensagem"] is not None
+                }
+            finally:
+                incidente.alerta_enviado.set()
+            if recebido_em is not None:
+                metricas.observar("guardiao_alerta_ponta_a_ponta_ms", (time.perf_counter() - recebido_em) * 1000, tipo=normalizar_texto(tipo))
 
-    for admin_id in ADMIN_CHAT_IDS:
         try:
-            context.bot.send_message(chat_id=admin_id, text=f"⚠️ Erro detectado: {mensagem}")
-        except Exception as e:
-            print(f"❌ Falha ao notificar admin ({admin_id}): {e}")
+            envio = await enfileirar_para_admins(
+                bot, destinatarios=incidente.destinatarios, prioridade=prioridade, duravel=True, text=mensagem, parse_mode='Markdown',
+                reply_markup=teclado_incidente(incidente),
+            )
+        except BaseException:
+            incidente.alerta_enviado.set()
+            raise
+        # O texto já está na fila: o áudio entra na mesma classe, logo atrás dele, e os dois seguem em paralelo
+        await asyncio.gather(
+            enviar_texto(envio),
+            tocar_som(bot, tipo, incidente.destinatarios, prioridade, legenda=f"🔊 *Alerta Sonoro* — Incidente #{incidente.identificador}"),
+        )
+        return incidente, True
+
+    def anexar(self, bot, incidente, texto, detalhes=None):
+        """ Enfileira uma atualização; as que chegam dentro de INTERVALO_AGRUPAMENTO vão juntas """
+        historico_incidentes.registrar(incidente, "atualizacao", detalhe=detalhes)
+        incidente.ultima_atividade = time.monotonic()
+        incidente.pendentes.append(texto)
+        if incidente.tarefa_agrupamento is None:
+            incidente.tarefa_agrupamento = asyncio.create_task(self._enviar_pendentes(bot, incidente))
+
+    async def _enviar_pendentes(self, bot, incidente):
+        try:
+            await asyncio.sleep(INTERVALO_AGRUPAMENTO)
+            await incidente.alerta_enviado.wait()
+        finally:
+            incidente.tarefa_agrupamento = None
+        pendentes, incidente.pendentes = incidente.pendentes, []
+        if not pendentes:
+            return
+        incidente.atualizacoes += len(pendentes)
+
+        texto = f"➕ *Incidente #{incidente.identificador}* ({escapar_markdown(incidente.dados_escola['Escola'])})\n\n"
+        texto += "\n\n".join(pendentes)
+        if len(texto) > LIMITE_TEXTO_TELEGRAM:
+            texto = texto[:LIMITE_TEXTO_TELEGRAM - 20] + "\n\n(…mensagem cortada)"
+        await self.responder_no_alerta(bot, incidente, texto)
+
+    async def responder_no_alerta(self, bot, incidente, texto):
+        """ Envia o texto a cada destinatário como resposta ao alerta original do incidente """
+        return await self.repassar(bot, incidente, "send_message", text=texto, parse_mode='Markdown')
+
+    async def repassar(self, bot, incidente, metodo, **kwargs):
+        """ Faz a mesma chamada para todos os destinatários do incidente, em paralelo, respondendo ao alerta de cada um """
+        envios = []
+        for admin_id in incidente.destinatarios:
+            extras = {}
+            if admin_id in incidente.mensagens_admin:
+                extras = {"reply_to_message_id": incidente.mensagens_admin[admin_id], "allow_sending_without_reply": True}
+            envios.append(enviar_para_admins(
+                bot, metodo, [admin_id], incidente.prioridade, duravel=True, **kwargs, **extras,
+            ))
+        status = {}
+        for resultado in await asyncio.gather(*envios):
+            status.update(resultado)
+        return status
+
+    async def repassar_midia(self, bot, incidente, mensagem, tipo_midia, autor):
+        """
+        Repassa foto, áudio, vídeo, documento ou localização ao incidente com copy_message:
+        o Telegram copia o conteúdo no servidor, sem o bot baixar e reenviar os bytes.
+        """
+        incidente.ultima_atividade = time.monotonic()
+        incidente.atualizacoes += 1
+        legenda = mensagem.caption or ""
+        historico_incidentes.registrar(incidente, "atualizacao", detalhe=f"[{tipo_midia}] {legenda}".strip())
+        metricas.incrementar("guardiao_midias_repassadas_total", tipo=tipo_midia)
+        if mensagem.location is not None:
+            incidente.localizacoes[str(mensagem.chat_id)] = (time.monotonic(), (mensagem.location.latitude, mensagem.location.longitude))
+
+        extras = {}
+        if mensagem.location is None:
+            # Legenda em texto puro (sem parse_mode), então não precisa de escape
+            cabecalho = f"📎 Incidente #{incidente.identificador} ({incidente.dados_escola['Escola']}) — @{autor}"
+            extras["caption"] = (cabecalho + ("\n" + legenda if legenda else ""))[:LIMITE_LEGENDA_TELEGRAM]
+        await incidente.alerta_enviado.wait()  # Para responder ao alerta, ele precisa ter saído
+        return await self.repassar(
+            bot, incidente, "copy_message", from_chat_id=mensagem.chat_id, message_id=mensagem.message_id, **extras,
+        )
+
+    async def repassar_localizacao_ao_vivo(self, bot, incidente, mensagem):
+        """
+        Atualização da localização em tempo real: repassada no máximo a cada INTERVALO_LOCALIZACAO_AO_VIVO
+        segundos e só se o remetente se deslocou pelo menos DISTANCIA_MINIMA_LOCALIZACAO metros.
+        """
+        posicao = (mensagem.location.latitude, mensagem.location.longitude)
+        anterior = incidente.localizacoes.get(str(mensagem.chat_id))
+        if anterior is not None:
+            instante, posicao_anterior = anterior
+            if (time.monotonic() - instante < INTERVALO_LOCALIZACAO_AO_VIVO
+                    or distancia_km(posicao_anterior, posicao) * 1000 < DISTANCIA_MINIMA_LOCALIZACAO):
+                metricas.incrementar("guardiao_localizacoes_suprimidas_total")
+                return {}
+        incidente.localizacoes[str(mensagem.chat_id)] = (time.monotonic(), posicao)
+        incidente.ultima_atividade = time.monotonic()
+        await incidente.alerta_enviado.wait()
+        metricas.incrementar("guardiao_midias_repassadas_total", tipo="localizacao_ao_vivo")
+        return await self.repassar(bot, incidente, "copy_message", from_chat_id=mensagem.chat_id, message_id=mensagem.message_id)
+
+gerenciador_incidentes = GerenciadorIncidentes()
+
+def nome_do_usuario(usuario, chat_id):
+    return (usuario.username or usuario.first_name or chat_id) if usuario else chat_id
+
+def renderizar_atualizacao(tipo, detalhes, usuario, chat_id, tipo_mensagem="livre"):
+    if tipo_mensagem == "comando":
+        corpo = f"⚠️ Botão de emergência acionado novamente: *{escapar_markdown(tipo.upper())}*"
+    else:
+        corpo = f"📩 \"{escapar_markdown((detalhes or '').upper())}\""
+    autor = escapar_markdown(nome_do_usuario(usuario, chat_id)) if usuario else chat_id
+    return f"🕒 {time.strftime('%H:%M:%S')} — @{autor}\n{corpo}"
+
+def teclado_incidente(incidente):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Ciente", callback_data=f"incidente:{incidente.identificador}:reconhecer"),
+        InlineKeyboardButton("🔒 Encerrar", callback_data=f"incidente:{incidente.identificador}:encerrar"),
+    ]])
+
+def texto_confirmacao_emergencia(tipo):
+    return (
+        f"Mensagem Recebida. Identificamos que vocês estão em situação de emergência envolvendo {tipo.lower()}, o Guardião Escolar foi ativado e em breve uma equipe chegará ao seu local. "
+        "Mantenha-se em segurança e, se possível, envie uma nova mensagem com mais detalhes sobre o que está acontecendo, quantos envolvidos, meios utilizados e se há alguém necessitando de suporte médico."
+    )
+
+async def responder_usuario(bot, chat_id, texto, **kwargs):
+    """
+    Responde ao remetente com os mesmos limites e novas tentativas dos envios aos administradores.
+    Nunca levanta exceção: uma resposta recusada (ex.: 429) não pode interromper o alerta.
+    """
+    resultado = await enviar_com_limite(bot, "send_message", chat_id, text=texto, **kwargs)
+    if resultado["status"] != "entregue":
+        print(f"❌ Falha ao responder {chat_id}: {resultado['erro']}")
+    return resultado
+
+MENSAGEM_FORA_DE_EMERGENCIA = (
+    "⚠️ Este canal é exclusivo para comunicação de emergências.\n\n"
+    "Siga as orientações do menu /ajuda. Se você estiver em uma situação de emergência, "
+    "lembre-se de inserir a palavra-chave correspondente e incluir o máximo de detalhes possível.\n"
+    "📞 Inclua também um número de contato para que possamos falar com você."
+)
+
+MENSAGEM_ATUALIZACAO_RECEBIDA = (
+    "Informação recebida e repassada à equipe que já está atendendo a sua escola. "
+    "Mantenha-se em segurança e continue enviando detalhes, se possível."
+)
+
+# 🔹 Botões "Ciente" / "Encerrar" dos alertas
+async def responder_incidente(update: Update, context: CallbackContext):
+    query = update.callback_query
+    chat_id = str(query.message.chat_id)
+    if not eh_equipe(chat_id):
+        await query.answer("Apenas administradores podem alterar incidentes.")
+        return
+
+    _, identificador, acao = query.data.split(":")
+    incidente = gerenciador_incidentes.por_id.get(int(identificador))
+    if incidente is None:
+        await query.answer("Este incidente já foi encerrado.")
+        return
+    if chat_id not in incidente.destinatarios:
+        await query.answer("Este incidente é atendido por outra equipe.")
+        return
+
+    nome_admin = str(query.from_user.first_name or query.from_user.username or query.from_user.id)
+    admin = escapar_markdown(nome_admin)
+    if acao == "reconhecer":
+        if incidente.estado == ESTADO_RECONHECIDO:
+            await query.answer(f"Já reconhecido por {incidente.reconhecido_por}.")
+            return
+        incidente.estado = ESTADO_RECONHECIDO
+        incidente.reconhecido_por = admin
+        historico_incidentes.registrar(incidente, "reconhecido", nome_admin)
+        await query.answer("Incidente marcado como ciente.")
+        texto = f"✅ *Incidente #{incidente.identificador}* reconhecido por {admin}."
+    else:
+        gerenciador_incidentes.encerrar(incidente, autor=nome_admin)
+        await query.answer("Incidente encerrado.")
+        texto = f"🔒 *Incidente #{incidente.identificador}* encerrado por {admin}."
+    await gerenciador_incidentes.responder_no_alerta(context.bot, incidente, texto)
 
 # Função para exibir a mensagem de boas-vindas
 async def start(update: Update, context: CallbackContext):
@@ -92,386 +1864,973 @@ async def ajuda(update: Update, context: CallbackContext):
     await update.message.reply_text(mensagem_ajuda, parse_mode='Markdown')
 
 # 🔹 Funções específicas para cada comando
-def bomba(update: Update, context: CallbackContext):
+async def bomba(update: Update, context: CallbackContext):
     print("⚠️ Comando /bomba acionado")
-    comando_emergencia(update, context, "bomba")
+    await comando_emergencia(update, context, "bomba")
 
-def ameaca(update: Update, context: CallbackContext):
+async def ameaca(update: Update, context: CallbackContext):
     print("⚠️ Comando /ameaca acionado")
-    comando_emergencia(update, context, "ameaça")
+    await comando_emergencia(update, context, "ameaça")
 
-def refem(update: Update, context: CallbackContext):
+async def refem(update: Update, context: CallbackContext):
     print("⚠️ Comando /refem acionado")
-    comando_emergencia(update, context, "refém")
+    await comando_emergencia(update, context, "refém")
 
-def agressor(update: Update, context: CallbackContext):
+async def agressor(update: Update, context: CallbackContext):
     print("⚠️ Comando /agressor acionado")
-    comando_emergencia(update, context, "agressor")
+    await comando_emergencia(update, context, "agressor")
 
-def homicidio(update: Update, context: CallbackContext):
+async def homicidio(update: Update, context: CallbackContext):
     print("⚠️ Comando /homicidio acionado")
-    comando_emergencia(update, context, "homicídio")
+    await comando_emergencia(update, context, "homicídio")
 
-def teste(update: Update, context: CallbackContext):
+async def teste(update: Update, context: CallbackContext):
     print("⚠️ Comando /teste acionado")
-    comando_emergencia(update, context, "teste")
+    await comando_emergencia(update, context, "teste")
 
-def cadastro(update: Update, context: CallbackContext):
+async def cadastro(update: Update, context: CallbackContext):
     chat_id = str(update.message.chat_id)
     nome = update.message.from_user.first_name or "Nome não informado"
     username = update.message.from_user.username or "Sem username"
 
     print(f"📌 Novo pedido de cadastro recebido: Nome={nome}, Username={username}, Chat ID={chat_id}")
+    metricas.incrementar("guardiao_pedidos_cadastro_total")
+
+    # Mesma proteção dos não cadastrados: resposta limitada por chat e aviso aos administradores só no resumo
+    if not controle_desconhecidos.registrar(chat_id, update.message.from_user, cadastro=True):
+        return
 
     mensagem_confirmacao = (
         "📌 *Sua solicitação foi enviada para análise.*\n"
         "Aguarde o contato de um administrador."
     )
-    update.message.reply_text(mensagem_confirmacao, parse_mode="Markdown")
-
-    mensagem_admin = (
-        f"📌 *Novo usuário solicitando cadastro!*\n\n"
-        f"🔹 *Chat ID*: `{chat_id}`\n"
-        f"👤 *Nome*: {nome}\n"
-        f"🔹 *Username*: @{username}\n\n"
-        f"Para cadastrá-lo, insira manualmente os dados na planilha."
-    )
+    await responder_usuario(context.bot, chat_id, mensagem_confirmacao, parse_mode="Markdown")
+
+# 🔹 Usuários não cadastrados: respostas limitadas por chat e avisos aos administradores em resumo
+LIMITE_RESPOSTAS_DESCONHECIDO = float(os.getenv("LIMITE_RESPOSTAS_DESCONHECIDO", "1"))  # respostas por minuto
+RAJADA_RESPOSTAS_DESCONHECIDO = int(os.getenv("RAJADA_RESPOSTAS_DESCONHECIDO", "2"))
+# Teto somando todos os chats não cadastrados: o restante do LIMITE_GLOBAL_POR_SEGUNDO fica para os alertas
+LIMITE_TOTAL_RESPOSTAS_DESCONHECIDOS = float(os.getenv("LIMITE_TOTAL_RESPOSTAS_DESCONHECIDOS", "3"))  # respostas por segundo
+MAXIMO_DESCONHECIDOS = int(os.getenv("MAXIMO_DESCONHECIDOS", "1000"))  # chats lembrados (LRU)
+INTERVALO_RESUMO_DESCONHECIDOS = float(os.getenv("INTERVALO_RESUMO_DESCONHECIDOS", "300"))  # segundos
+MAXIMO_ITENS_RESUMO = 30  # chats listados por resumo; os demais entram só na contagem
+
+MENSAGEM_NAO_AUTORIZADA = (
+    "⚠️ *Canal exclusivo para as Instituições de Ensino cadastradas.*\n"
+    "Favor entrar em contato com o 190 em caso de emergência.\n\n"
+    "Caso tenha interesse em se cadastrar, envie a mensagem \"CADASTRO\"."
+)
+
+class ControleDesconhecidos:
+    """
+    Memória limitada dos chats não cadastrados que escreveram ao bot.
+    Cada chat tem um balde de tokens para as respostas automáticas, e um balde comum limita
+    o total de respostas (muitos chats diferentes não esgotam o limite global); os administradores
+    não recebem uma mensagem por contato, e sim um resumo periódico com os chats novos
+    e os pedidos de /cadastro (um por chat, por mais que o comando se repita).
+    Tudo fica em memória com tamanho fixo: os chats menos recentes saem primeiro (LRU).
+    """
 
-    for admin_id in ADMIN_CHAT_IDS:
-        try:
-            context.bot.send_message(chat_id=admin_id, text=mensagem_admin, parse_mode='Markdown')
-            print(f"✅ Notificação de cadastro enviada para {admin_id}")
-        except Exception as e:
-            print(f"❌ Erro ao enviar notificação de cadastro para {admin_id}: {e}")
+    def __init__(self, maximo, taxa, rajada, taxa_total):
+        self.maximo = maximo
+        self.taxa = taxa
+        self.rajada = rajada
+        self.balde_total = BaldeDeTokens(taxa_total, max(1, int(taxa_total)))
+        self.chats = collections.OrderedDict()  # chat_id -> dados do contato, do menos para o mais recente
+        self.novos = collections.OrderedDict()  # chat_id -> None, ainda não informados no resumo
+        self.novos_omitidos = 0  # novos que não couberam no resumo
+        self.cadastros = collections.OrderedDict()  # chat_id -> None, pedidos de cadastro ainda não informados
+        self.cadastros_omitidos = 0
+        self.mensagens = 0
+        self.respostas_suprimidas = 0
+        self.descartados = 0
+
+    def registrar(self, chat_id, usuario, cadastro=False):
+        """ Registra a mensagem (ou o pedido de /cadastro) e diz se o chat ainda pode receber a resposta automática """
+        self.mensagens += 1
+        contato = self.chats.get(chat_id)
+        if contato is None:
+            contato = self.chats[chat_id] = {
+                "balde": BaldeDeTokens(self.taxa, self.rajada),
+                "nome": (usuario.first_name if usuario else None) or "Nome não informado",
+                "username": (usuario.username if usuario else None) or "Sem username",
+                "mensagens": 0,
+                "cadastro": False,
+            }
+            if not cadastro:  # Pedidos de cadastro entram no resumo em uma seção própria, logo abaixo
+                if len(self.novos) < MAXIMO_ITENS_RESUMO:
+                    self.novos[chat_id] = None
+                else:
+                    self.novos_omitidos += 1
+            if len(self.chats) > self.maximo:
+                antigo, _ = self.chats.popitem(last=False)
+                self.novos.pop(antigo, None)
+                self.cadastros.pop(antigo, None)
+                self.descartados += 1
+        else:
+            self.chats.move_to_end(chat_id)
+        contato["mensagens"] += 1
+        if cadastro and not contato["cadastro"]:
+            contato["cadastro"] = True
+            self.novos.pop(chat_id, None)
+            if len(self.cadastros) < MAXIMO_ITENS_RESUMO:
+                self.cadastros[chat_id] = None
+            else:
+                self.cadastros_omitidos += 1
+
+        if contato["balde"].tentar_consumir() and self.balde_total.tentar_consumir():
+            return True
+        self.respostas_suprimidas += 1
+        return False
+
+    def _listar(self, chat_ids, omitidos):
+        linhas = []
+        for chat_id in chat_ids:
+            contato = self.chats[chat_id]
+            linhas.append(
+                f"🔹 `{chat_id}` — {escapar_markdown(contato['nome'])} "
+                f"(@{escapar_markdown(contato['username'])}), {contato['mensagens']} mensagem(ns)"
+            )
+        if omitidos:
+            linhas.append(f"… e mais {omitidos} chat(s) não listados.")
+        return "\n".join(linhas)
+
+    def resumo(self):
+        """ Texto do resumo com os chats novos e os pedidos de cadastro desde o último, ou None se não houver novidade """
+        if not self.novos and not self.novos_omitidos and not self.cadastros and not self.cadastros_omitidos:
+            return None
+        secoes = []
+        if self.cadastros or self.cadastros_omitidos:
+            total = len(self.cadastros) + self.cadastros_omitidos
+            secoes.append(f"📝 *{total} pedido(s) de cadastro*\n\n" + self._listar(self.cadastros, self.cadastros_omitidos))
+        if self.novos or self.novos_omitidos:
+            total = len(self.novos) + self.novos_omitidos
+            secoes.append(
+                f"📌 *{total} novo(s) usuário(s) tentando interagir com o bot*\n\n" + self._listar(self.novos, self.novos_omitidos)
+            )
+        mensagem = "\n\n".join(secoes)
+        mensagem += (
+            f"\n\n📨 Mensagens de não cadastrados até agora: {self.mensagens} "
+            f"({self.respostas_suprimidas} sem resposta automática por excesso).\n"
+            "Para cadastrá-los, insira manualmente os dados na planilha."
+        )
+        self.novos.clear()
+        self.novos_omitidos = 0
+        self.cadastros.clear()
+        self.cadastros_omitidos = 0
+        return mensagem
+
+controle_desconhecidos = ControleDesconhecidos(
+    MAXIMO_DESCONHECIDOS, LIMITE_RESPOSTAS_DESCONHECIDO / 60, RAJADA_RESPOSTAS_DESCONHECIDO, LIMITE_TOTAL_RESPOSTAS_DESCONHECIDOS
+)
+
+async def tratar_usuario_desconhecido(update, context, chat_id):
+    """ Responde (dentro do limite do chat) e deixa o aviso aos administradores para o próximo resumo """
+    metricas.incrementar("guardiao_usuarios_desconhecidos_total")
+    if controle_desconhecidos.registrar(chat_id, update.effective_message.from_user):
+        await responder_usuario(context.bot, chat_id, MENSAGEM_NAO_AUTORIZADA, parse_mode='Markdown')
+
+async def enviar_resumos_desconhecidos(bot):
+    """ A cada INTERVALO_RESUMO_DESCONHECIDOS, informa aos administradores os chats não cadastrados novos """
+    while True:
+        await asyncio.sleep(INTERVALO_RESUMO_DESCONHECIDOS)
+        prioridade = PRIORIDADE_CADASTRO if controle_desconhecidos.cadastros else PRIORIDADE_DIAGNOSTICO
+        mensagem = controle_desconhecidos.resumo()
+        if mensagem:
+            await enviar_para_admins(bot, prioridade=prioridade, text=mensagem, parse_mode='Markdown')
+
+async def varrer_incidentes():
+    """ A cada INTERVALO_VARREDURA_INCIDENTES, encerra os incidentes que expiraram sem novas mensagens """
+    while True:
+        await asyncio.sleep(INTERVALO_VARREDURA_INCIDENTES)
+        gerenciador_incidentes.encerrar_expirados()
 
 # 🔹 Função principal de emergência e notificações
 async def comando_emergencia(update: Update, context: CallbackContext, tipo: str):
-    global emergencia_ativa
+    recebido_em = time.perf_counter()
+    try:
+        await _comando_emergencia(update, context, tipo, recebido_em)
+    finally:
+        metricas.observar("guardiao_handler_ms", (time.perf_counter() - recebido_em) * 1000, handler="comando_emergencia")
+
+async def _comando_emergencia(update, context, tipo, recebido_em):
     chat_id = str(update.message.chat_id)
-    texto = update.message.text
-    dados_escola = buscar_dados_escola(chat_id)
+    dados_escola = await obter_dados_escola(chat_id)
 
-    # ✅ Se o usuário NÃO estiver cadastrado, notifica os administradores automaticamente
+    # ✅ Se o usuário NÃO estiver cadastrado, os administradores recebem o aviso no próximo resumo
     if not dados_escola:
-        mensagem_nao_autorizada = (
-            "⚠️ *Canal exclusivo para as Instituições de Ensino cadastradas.*\n"
-            "Favor entrar em contato com o 190 em caso de emergência.\n\n"
-            "Caso tenha interesse em se cadastrar, envie a mensagem \"CADASTRO\"."
-        )
-        await update.message.reply_text(mensagem_nao_autorizada, parse_mode='Markdown')
-
-        # ✅ Enviar notificação para os administradores com os dados do novo usuário
-        mensagem_admin = (
-            f"📌 *Novo usuário tentando interagir com o bot!*\n\n"
-            f"🔹 *Chat ID*: `{chat_id}`\n"
-            f"👤 *Nome*: {update.message.from_user.first_name or 'Nome não informado'}\n"
-            f"🔹 *Username*: @{update.message.from_user.username or 'Sem username'}\n\n"
-            f"Para cadastrá-lo, insira manualmente os dados na planilha."
-        )
-
-        for admin_id in ADMIN_CHAT_IDS:
-            try:
-                context.bot.send_message(chat_id=admin_id, text=mensagem_admin, parse_mode='Markdown')
-                print(f"📌 Notificação de novo usuário enviada para {admin_id}")
-            except Exception as e:
-                print(f"❌ Erro ao enviar notificação de cadastro para {admin_id}: {e}")
-
+        await tratar_usuario_desconhecido(update, context, chat_id)
         return  # Bloqueia qualquer outra ação para usuários não cadastrados.
 
     # ✅ Usuário cadastrado - processamento normal
-    texto_normalizado = normalizar_texto(texto)
-    emergencia_ativa = True  # Ativando emergência
-    print(f"⚠️ Emergência ativada: {tipo.upper()} para {dados_escola['Escola']}")
-
-    # ✅ Confirmação para o usuário
-    await update.message.reply_text(
-        f"Mensagem Recebida. Identificamos que vocês estão em situação de emergência envolvendo {tipo.lower()}, o Guardião Escolar foi ativado e em breve uma equipe chegará ao seu local. "
-        "Mantenha-se em segurança e, se possível, envie uma nova mensagem com mais detalhes sobre o que está acontecendo, quantos envolvidos, meios utilizados e se há alguém necessitando de suporte médico."
-    )
-
-    # ✅ Alerta detalhado para os administradores
-    mensagem_para_admins = (
-        f"⚠️ *Mensagem de emergência recebida:*\n\n"
-        f"🏫 *Escola*: {dados_escola['Escola']}\n"
-        f"👤 *Servidor*: {dados_escola['Nome']}\n"
-        f"👤 *Função*: {dados_escola['Função']}\n"
-        f"📞 *Telefone*: {dados_escola['Telefone']}\n"
-        f"✉️ *Email*: {dados_escola['Email']}\n"
-        f"📍 *Endereço*: {dados_escola['Endereço']}\n"
-        f"🌐 *Localização*: {dados_escola['Localização']}\n\n"
-        f"📩 *Mensagem original*: {texto.upper()}\n"
-        f"👤 *Usuário*: @{update.message.from_user.username or 'Sem username'} "
-        f"(Nome: {update.message.from_user.first_name}, Chat ID: {chat_id})"
+    incidente = gerenciador_incidentes.ativo(dados_escola, chat_id)
+    if incidente is None or prioridade_do_tipo(tipo) < incidente.prioridade:
+        resposta = texto_confirmacao_emergencia(tipo)
+    else:
+        resposta = MENSAGEM_ATUALIZACAO_RECEBIDA
+
+    # ✅ Confirmação para o usuário e alerta para os administradores (novo incidente ou
+    # atualização do incidente em andamento), em paralelo: uma falha na resposta não segura o alerta
+    await asyncio.gather(
+        responder_usuario(context.bot, chat_id, resposta),
+        gerenciador_incidentes.registrar(
+            context.bot, dados_escola, tipo, None, update.message.from_user, chat_id, tipo_mensagem="comando",
+            recebido_em=recebido_em,
+        ),
     )
 
-    for admin_id in ADMIN_CHAT_IDS:
-        try:
-            context.bot.send_message(chat_id=admin_id, text=mensagem_para_admins, parse_mode='Markdown')
-            print(f"✅ Notificação de emergência enviada para {admin_id}")
-        except Exception as e:
-            print(f"❌ Erro ao enviar alerta para {admin_id}: {e}")
-
-    emergencia_ativa = False  # Finaliza a emergência
-
 # 🔹 Função para lidar com mensagens de emergência enviadas como texto livre
 async def mensagem_recebida(update: Update, context: CallbackContext):
-    global emergencia_ativa  # Controle de emergência
+    recebido_em = time.perf_counter()
     try:
         chat_id = str(update.message.chat_id)
         texto = update.message.text
-        dados_escola = buscar_dados_escola(chat_id)
+        dados_escola = await obter_dados_escola(chat_id)
 
-        # ✅ Se o usuário NÃO estiver cadastrado, notifica os administradores automaticamente
+        # ✅ Se o usuário NÃO estiver cadastrado, os administradores recebem o aviso no próximo resumo
         if not dados_escola:
-            mensagem_nao_autorizada = (
-                "⚠️ *Canal exclusivo para as Instituições de Ensino cadastradas.*\n"
-                "Favor entrar em contato com o 190 em caso de emergência.\n\n"
-                "Caso tenha interesse em se cadastrar, envie a mensagem \"CADASTRO\"."
-            )
-            await update.message.reply_text(mensagem_nao_autorizada, parse_mode='Markdown')
-
-            # ✅ Enviar notificação para os administradores com os dados do novo usuário
-            mensagem_admin = (
-                f"📌 *Novo usuário tentando interagir com o bot!*\n\n"
-                f"🔹 *Chat ID*: `{chat_id}`\n"
-                f"👤 *Nome*: {update.message.from_user.first_name or 'Nome não informado'}\n"
-                f"🔹 *Username*: @{update.message.from_user.username or 'Sem username'}\n\n"
-                f"Para cadastrá-lo, insira manualmente os dados na planilha."
-            )
-
-            for admin_id in ADMIN_CHAT_IDS:
-                try:
-                    context.bot.send_message(chat_id=admin_id, text=mensagem_admin, parse_mode='Markdown')
-                    print(f"📌 Notificação de novo usuário enviada para {admin_id}")
-                except Exception as e:
-                    print(f"❌ Erro ao notificar administradores sobre novo usuário ({admin_id}): {e}")
-
+            await tratar_usuario_desconhecido(update, context, chat_id)
             return  # Bloqueia qualquer outra ação para usuários não cadastrados.
 
         # ✅ Se o usuário está cadastrado, continua normalmente.
-        texto_normalizado = normalizar_texto(texto)
-        palavra_chave_encontrada = False
-
-        for palavra in ["AGRESSOR", "HOMICIDIO", "REFEM", "BOMBA", "SOCORRO", "TESTE"]:
-            if palavra in texto_normalizado:
-                palavra_chave_encontrada = True
-                emergencia_ativa = True  # Ativando emergência
-                print(f"⚠️ Emergência ativada: {palavra.upper()} para {dados_escola['Escola']}")
-
-                # ✅ Confirmação para o usuário
-                await update.message.reply_text(
-                    f"Mensagem Recebida. Identificamos que vocês estão em situação de emergência envolvendo {palavra.lower()}, o Guardião Escolar foi ativado e em breve uma equipe chegará ao seu local. "
-                    "Mantenha-se em segurança e, se possível, envie uma nova mensagem com mais detalhes sobre o que está acontecendo, quantos envolvidos, meios utilizados e se há alguém necessitando de suporte médico."
-                )
-
-                # ✅ Alerta detalhado para os administradores
-                mensagem_para_admins = (
-                    f"⚠️ *Mensagem de emergência recebida:*\n\n"
-                    f"🏫 *Escola*: {dados_escola['Escola']}\n"
-                    f"👤 *Servidor*: {dados_escola['Nome']}\n"
-                    f"👤 *Função*: {dados_escola['Função']}\n"
-                    f"📞 *Telefone*: {dados_escola['Telefone']}\n"
-                    f"✉️ *Email*: {dados_escola['Email']}\n"
-                    f"📍 *Endereço*: {dados_escola['Endereço']}\n"
-                    f"🌐 *Localização*: {dados_escola['Localização']}\n\n"
-                    f"📩 *Mensagem original*: {texto.upper()}\n"
-                    f"👤 *Usuário*: @{update.message.from_user.username or 'Sem username'} "
-                    f"(Nome: {update.message.from_user.first_name}, Chat ID: {chat_id})"
-                )
-
-                for admin_id in ADMIN_CHAT_IDS:
-                    try:
-                        context.bot.send_message(
-                            chat_id=admin_id,
-                            text=mensagem_para_admins,
-                            parse_mode='Markdown'
-                        )
-                        print(f"✅ Notificação de emergência enviada para {admin_id}")
-                    except Exception as e:
-                        print(f"❌ Erro ao enviar alerta para {admin_id}: {e}")
-
-                emergencia_ativa = False  # Finaliza a emergência
-                break
+        categorias = classificador.classificar(texto)
+        palavra_chave_encontrada = bool(categorias)
+        incidente = gerenciador_incidentes.ativo(dados_escola, chat_id)
+
+        if categorias:
+            # A categoria mais urgente define a resposta; as demais seguem no alerta
+            palavra = categorias[0][1]
+            if incidente is None or prioridade_do_tipo(palavra) < incidente.prioridade:
+                resposta = texto_confirmacao_emergencia(palavra)
+            else:
+                resposta = MENSAGEM_ATUALIZACAO_RECEBIDA
+
+            # ✅ Confirmação para o usuário e alerta para os administradores, em paralelo
+            await asyncio.gather(
+                responder_usuario(context.bot, chat_id, resposta),
+                gerenciador_incidentes.registrar(
+                    context.bot, dados_escola, palavra, texto, update.message.from_user, chat_id,
+                    outras=[categoria for _, categoria in categorias[1:]], recebido_em=recebido_em,
+                ),
+            )
 
-        if not palavra_chave_encontrada:
-            mensagem_erro = (
-                "⚠️ Este canal é exclusivo para comunicação de emergências.\n\n"
-                "Siga as orientações do menu /ajuda. Se você estiver em uma situação de emergência, "
-                "lembre-se de inserir a palavra-chave correspondente e incluir o máximo de detalhes possível.\n"
-                "📞 Inclua também um número de contato para que possamos falar com você."
+        elif incidente is not None:
+            # ✅ Detalhes enviados sem palavra-chave durante um incidente em andamento
+            palavra_chave_encontrada = True
+            gerenciador_incidentes.anexar(
+                context.bot, incidente, renderizar_atualizacao(incidente.tipo, texto, update.message.from_user, chat_id), texto
             )
-            await update.message.reply_text(mensagem_erro)
+            await responder_usuario(context.bot, chat_id, MENSAGEM_ATUALIZACAO_RECEBIDA)
+
+        if not palavra_chave_encontrada:
+            await responder_usuario(context.bot, chat_id, MENSAGEM_FORA_DE_EMERGENCIA)
 
     except Exception as e:
-        emergencia_ativa = False
         print(f"❌ Erro ao processar mensagem: {e}")
         try:
-            for admin_id in ADMIN_CHAT_IDS:
-                context.bot.send_message(chat_id=admin_id, text=f"⚠️ Erro detectado ao processar uma mensagem: {e}")
+            await enviar_para_admins(context.bot, prioridade=PRIORIDADE_DIAGNOSTICO, text=f"⚠️ Erro detectado ao processar uma mensagem: {e}")
         except Exception as admin_error:
             print(f"❌ Falha ao notificar administradores sobre erro: {admin_error}")
+    finally:
+        metricas.observar("guardiao_handler_ms", (time.perf_counter() - recebido_em) * 1000, handler="mensagem_recebida")
 
-# 🔹 Função para enviar alerta e áudio no Telegram
-def exibir_alerta(dados_escola, tipo, detalhes, tipo_mensagem="livre", context=None):
-    """
-    Envia um alerta de emergência para os administradores do bot no Telegram.
-    Inclui um áudio de alerta se disponível no servidor.
-    """
-
-    # Verifica o tipo de mensagem e ajusta o conteúdo exibido
-    if tipo_mensagem == "comando":
-        mensagem_ajustada = (
-            f"⚠️ *Usuário acionou o botão de emergência: {tipo.upper()}*.\n"
-            f"O solicitante pode estar em perigo. Prossiga com brevidade e cautela.⚠️"
-        )
-    else:
-        mensagem_ajustada = (
-            f"⚠️ *Mensagem de emergência recebida:*\n"
-            f"\"{detalhes.upper()}\"\n"
-            f"Usuário pode estar em perigo. Prossiga com brevidade e cautela.⚠️"
-        )
+# 🔹 Fotos, áudios, vídeos, documentos e localizações das escolas: anexados ao incidente em andamento
+TIPOS_DE_MIDIA = (
+    ("photo", "foto"), ("voice", "voz"), ("audio", "audio"), ("video", "video"),
+    ("video_note", "video"), ("document", "documento"), ("location", "localizacao"),
+)
 
-    # Formata a mensagem completa do alerta
-    mensagem = (
-        f"🚨 *ALERTA DE EMERGÊNCIA* 🚨\n\n"
-        f"🏫 *Escola*: {dados_escola['Escola']}\n"
-        f"👤 *Servidor*: {dados_escola['Nome']}\n"
-        f"👤 *Função*: {dados_escola['Função']}\n"
-        f"📞 *Telefone*: {dados_escola['Telefone']}\n"
-        f"📩 *Email*: {dados_escola['Email']}\n"
-        f"📍 *Endereço*: {dados_escola['Endereço']}\n"
-        f"🌍 *Localização*: {dados_escola['Localização']}\n\n"
-        f"🔔 *Tipo de Emergência*: {tipo.upper()}\n"
-        f"{mensagem_ajustada}\n\n"
-        f"🆘 *Atenção*: Contatar imediatamente o solicitante!"
-    )
+def tipo_da_midia(mensagem):
+    return next((nome for atributo, nome in TIPOS_DE_MIDIA if getattr(mensagem, atributo)), "outro")
 
-    # Caminho do arquivo de áudio (deve estar no servidor)
-    caminho_audio = "alerta.mp3" if tipo.lower() != "teste" else "teste.mp3"
+async def midia_recebida(update: Update, context: CallbackContext):
+    recebido_em = time.perf_counter()
+    try:
+        mensagem = update.effective_message
+        chat_id = str(mensagem.chat_id)
+        dados_escola = await obter_dados_escola(chat_id)
+        if not dados_escola:
+            # Cada atualização da localização em tempo real chega como edição: só a mensagem original conta
+            if update.edited_message is None:
+                await tratar_usuario_desconhecido(update, context, chat_id)
+            return
+
+        incidente = gerenciador_incidentes.ativo(dados_escola, chat_id)
+        if update.edited_message is not None:
+            # Edições que chegam aqui são atualizações da localização em tempo real
+            if incidente is not None and mensagem.location is not None:
+                await gerenciador_incidentes.repassar_localizacao_ao_vivo(context.bot, incidente, mensagem)
+            return
+
+        usuario = mensagem.from_user
+        legenda = mensagem.caption or ""
+        categorias = classificador.classificar(legenda) if legenda else []
+        if categorias:
+            # Legenda com palavra-chave: abre (ou atualiza) o incidente como uma mensagem de texto
+            palavra = categorias[0][1]
+            if incidente is None or prioridade_do_tipo(palavra) < incidente.prioridade:
+                resposta = texto_confirmacao_emergencia(palavra)
+            else:
+                resposta = MENSAGEM_ATUALIZACAO_RECEBIDA
+            _, (incidente, _) = await asyncio.gather(
+                responder_usuario(context.bot, chat_id, resposta),
+                gerenciador_incidentes.registrar(
+                    context.bot, dados_escola, palavra, legenda, usuario, chat_id,
+                    outras=[categoria for _, categoria in categorias[1:]], recebido_em=recebido_em,
+                ),
+            )
+            await gerenciador_incidentes.repassar_midia(
+                context.bot, incidente, mensagem, tipo_da_midia(mensagem), nome_do_usuario(usuario, chat_id)
+            )
+        elif incidente is not None:
+            await asyncio.gather(
+                responder_usuario(context.bot, chat_id, MENSAGEM_ATUALIZACAO_RECEBIDA),
+                gerenciador_incidentes.repassar_midia(
+                    context.bot, incidente, mensagem, tipo_da_midia(mensagem), nome_do_usuario(usuario, chat_id)
+                ),
+            )
+        else:
+            await responder_usuario(context.bot, chat_id, MENSAGEM_FORA_DE_EMERGENCIA)
 
-    # ✅ Enviar mensagem e áudio para os administradores no Telegram
-    for admin_id in ADMIN_CHAT_IDS:
+    except Exception as e:
+        print(f"❌ Erro ao processar mídia: {e}")
         try:
-            context.bot.send_message(chat_id=admin_id, text=mensagem, parse_mode="Markdown")
-            print(f"✅ Alerta de emergência enviado para {admin_id}")
+            await enviar_para_admins(context.bot, prioridade=PRIORIDADE_DIAGNOSTICO, text=f"⚠️ Erro detectado ao processar uma mídia: {e}")
+        except Exception as admin_error:
+            print(f"❌ Falha ao notificar administradores sobre erro: {admin_error}")
+    finally:
+        metricas.observar("guardiao_handler_ms", (time.perf_counter() - recebido_em) * 1000, handler="midia_recebida")
+
+# 🔹 Localização: das unidades de resposta atualiza a posição; das escolas vai para o incidente
+async def localizacao_recebida(update: Update, context: CallbackContext):
+    mensagem = update.effective_message
+    chat_id = str(mensagem.chat_id)
+    if not eh_equipe(chat_id):
+        await midia_recebida(update, context)
+        return
+
+    usuario = mensagem.from_user
+    nome = (usuario.first_name or usuario.username) if usuario else None
+    ao_vivo = mensagem.location.live_period is not None or update.edited_message is not None
+    unidades_resposta.atualizar(chat_id, nome or chat_id, mensagem.location.latitude, mensagem.location.longitude, ao_vivo)
+
+    # As atualizações da localização em tempo real chegam como mensagens editadas: só o compartilhamento é respondido
+    if update.message is not None:
+        print(f"📍 Posição da unidade {nome or chat_id} registrada{' (tempo real)' if ao_vivo else ''}")
+        await responder_usuario(
+            context.bot, chat_id,
+            "📍 Localização registrada. Esta unidade será acionada primeiro em alertas de escolas próximas.",
+        )
 
-            # Enviar áudio se disponível
-            with open(caminho_audio, "rb") as audio:
-                context.bot.send_audio(chat_id=admin_id, audio=audio, caption="🔊 *Alerta Sonoro*")
-                print(f"✅ Áudio de alerta enviado para {admin_id}")
+# 🔹 Cache de file_id dos áudios de alerta (evita reenviar o mp3 a cada alerta)
+class CacheDeAudios:
+    """
+    Guarda o file_id devolvido pelo Telegram para cada áudio, persistido em disco.
+    O arquivo só é enviado de novo quando o hash do conteúdo muda.
+    """
 
-        except Exception as e:
-            print(f"❌ Erro ao enviar alerta para {admin_id}: {e}")
+    def __init__(self, arquivo_cache):
+        self.arquivo_cache = arquivo_cache
+        self.entradas = {}  # nome do arquivo -> {"hash", "file_id"}
+        self.assinaturas = {}  # caminho -> ((mtime, tamanho), hash), evita reler o arquivo a cada alerta
+        self.travas = {}
+        try:
+            with open(arquivo_cache, encoding="utf-8") as f:
+                self.entradas = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"❌ Cache de áudios inválido, será recriado: {e}")
+
+    def _salvar(self):
+        temporario = f"{self.arquivo_cache}.tmp"
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(self.entradas, f)
+        os.replace(temporario, self.arquivo_cache)
+
+    def hash_do_arquivo(self, caminho):
+        info = os.stat(caminho)
+        assinatura = (info.st_mtime_ns, info.st_size)
+        conhecida = self.assinaturas.get(caminho)
+        if conhecida and conhecida[0] == assinatura:
+            return conhecida[1]
+        with open(caminho, "rb") as audio:
+            resumo = hashlib.sha256(audio.read()).hexdigest()
+        self.assinaturas[caminho] = (assinatura, resumo)
+        return resumo
+
+    def file_id(self, caminho):
+        entrada = self.entradas.get(os.path.basename(caminho))
+        if entrada and entrada["hash"] == self.hash_do_arquivo(caminho):
+            return entrada["file_id"]
+        return None
+
+    @staticmethod
+    def rejeitou_file_id(resultado):
+        """ BadRequest do Telegram dizendo que não conhece o file_id; rede, fila cheia ou bot bloqueado não contam """
+        erro = (resultado["erro"] or "").lower()
+        return resultado["status"] == "recusado" and ("file identifier" in erro or "file_id" in erro)
+
+    def invalidar(self, caminho):
+        if self.entradas.pop(os.path.basename(caminho), None) is not None:
+            self._salvar()
+
+    async def enviar(self, bot, caminho, destinatarios=None, **kwargs):
+        """ Envia o áudio a todos os destinatários, fazendo upload no máximo uma vez """
+        destinatarios = list(ADMIN_CHAT_IDS if destinatarios is None else destinatarios)
+        if not destinatarios:
+            return {}
+
+        status = {}
+        file_id = self.file_id(caminho)
+        if file_id:
+            status = await enviar_para_admins(bot, "send_audio", destinatarios, audio=file_id, **kwargs)
+            destinatarios = [chat_id for chat_id, resultado in status.items() if self.rejeitou_file_id(resultado)]
+            if not destinatarios:
+                return status
+            # O Telegram não reconhece mais o file_id (ex.: token do bot trocado): faz upload de novo para quem o recusou
+            self.invalidar(caminho)
+
+        trava = self.travas.setdefault(caminho, asyncio.Lock())
+        async with trava:
+            file_id = self.file_id(caminho)
+            restantes = destinatarios
+            while file_id is None and restantes:
+                # Upload para o primeiro destinatário; os demais recebem pelo file_id
+                primeiro, restantes = restantes[0], restantes[1:]
+                with open(caminho, "rb") as audio:
+                    conteudo = audio.read()
+                status.update(await enviar_para_admins(bot, "send_audio", [primeiro], audio=conteudo, **kwargs))
+                mensagem = status[primeiro]["mensagem"]
+                if mensagem is not None and mensagem.audio is not None:
+                    file_id = mensagem.audio.file_id
+                    self.entradas[os.path.basename(caminho)] = {"hash": self.hash_do_arquivo(caminho), "file_id": file_id}
+                    self._salvar()
+                    print(f"✅ Áudio {os.path.basename(caminho)} armazenado no cache (file_id)")
+
+        if restantes:
+            status.update(await enviar_para_admins(bot, "send_audio", restantes, audio=file_id, **kwargs))
+        return status
+
+cache_audios = CacheDeAudios(ARQUIVO_CACHE_AUDIOS)
+
+def caminho_do_audio(tipo):
+    """ Caminho do arquivo de áudio (deve estar no servidor) """
+    return os.path.join(DIRETORIO_BASE, "teste.mp3" if tipo.lower() == "teste" else "alerta.mp3")
 
 # 🔹 Função para alertar administradores sobre perda de conexão
-def exibir_alerta_conexao(context=None):
+async def exibir_alerta_conexao(bot, desde):
     """
-    Envia um alerta para os administradores informando que o bot perdeu a conexão com a internet.
+    Envia um alerta para os administradores informando que o bot perdeu a conexão com o Telegram.
+    Como a fila fica retida durante a queda, o aviso é entregue assim que a conexão voltar.
     """
 
     mensagem = (
         "⚠️ *Guardião Escolar Inoperante!*\n\n"
-        "🚨 *Motivo*: Falta de Conexão com a Internet.\n"
+        f"🚨 *Motivo*: Falta de conexão com o Telegram desde {time.strftime('%d/%m %H:%M:%S', time.localtime(desde))}.\n"
         "🔄 O sistema tentará reconectar automaticamente.\n\n"
         "⚙️ *Ação necessária*: Verifique a conexão do servidor!"
     )
 
     # ✅ Enviar mensagem para os administradores no Telegram
-    for admin_id in ADMIN_CHAT_IDS:
-        try:
-            context.bot.send_message(chat_id=admin_id, text=mensagem, parse_mode="Markdown")
-            print(f"❌ ALERTA: Guardião Escolar sem conexão! Notificação enviada para {admin_id}")
-        except Exception as e:
-            print(f"❌ Erro ao enviar alerta de conexão para {admin_id}: {e}")
+    print("❌ ALERTA: Guardião Escolar sem conexão! Notificando administradores...")
+    return await enviar_para_admins(bot, prioridade=PRIORIDADE_DIAGNOSTICO, text=mensagem, parse_mode="Markdown")
+
+async def exibir_retorno_conexao(bot, duracao, retidos):
+    mensagem = (
+        "✅ *Guardião Escolar operante novamente.*\n\n"
+        f"⏱️ *Tempo sem conexão*: {int(duracao // 60)} min {int(duracao % 60)} s\n"
+        f"📨 *Envios retidos e reenviados*: {retidos}"
+    )
+    print("✅ Conexão restabelecida! Notificando administradores...")
+    return await enviar_para_admins(bot, prioridade=PRIORIDADE_DIAGNOSTICO, text=mensagem, parse_mode="Markdown")
 
 
 # 🔹 Função para enviar o alerta sonoro no Telegram (substitui tocar_som)
-def tocar_som(tipo, context=None):
+async def tocar_som(bot, tipo, destinatarios=None, prioridade=None, legenda="🔊 *Alerta Sonoro!*"):
     """
-    Envia um áudio de alerta para os administradores via Telegram em vez de reproduzi-lo no servidor.
+    Envia um áudio de alerta para os destinatários via Telegram em vez de reproduzi-lo no servidor.
+    Usa o file_id em cache; o arquivo só é enviado quando ainda não está no Telegram.
     """
 
     # Define o caminho do arquivo de som
-    caminho_audio = "teste.mp3" if tipo.lower() == "teste" else "alerta.mp3"
+    caminho_audio = caminho_do_audio(tipo)
 
     # ✅ Envia o áudio para os administradores
-    for admin_id in ADMIN_CHAT_IDS:
-        try:
-            with open(caminho_audio, "rb") as audio:
-                context.bot.send_audio(chat_id=admin_id, audio=audio, caption="🔊 *Alerta Sonoro!*")
-                print(f"✅ Áudio de alerta enviado para {admin_id}")
-        except Exception as e:
-            print(f"❌ Erro ao enviar áudio para {admin_id}: {e}")
+    try:
+        return await cache_audios.enviar(
+            bot, caminho_audio, destinatarios,
+            prioridade=prioridade_do_tipo(tipo) if prioridade is None else prioridade, caption=legenda, parse_mode="Markdown",
+        )
+    except OSError as e:
+        print(f"❌ Erro ao ler o áudio de alerta ({caminho_audio}): {e}")
+        return {}
 
-# 🔹 Função para atualizar a planilha a cada 5 minutos em uma thread separada
-def atualizar_planilha_periodicamente():
+# 🔹 Tarefa assíncrona que atualiza a planilha periodicamente no loop do bot
+async def atualizar_planilha_periodicamente():
     """
-    Atualiza os dados da planilha online a cada 5 minutos, rodando como uma thread separada.
+    Atualiza os dados da planilha online a cada INTERVALO_ATUALIZACAO segundos (com jitter),
+    rodando no mesmo event loop do bot. Em caso de falha, aplica backoff exponencial.
     """
-    while True:
-        try:
-            carregar_dados_csv()
-            print("✅ Guardião Escolar - Planilha atualizada com sucesso!")
-        except Exception as e:
-            print(f"❌ Erro ao atualizar a planilha: {e}")
-        time.sleep(300)  # 300 segundos = 5 minutos
+    global ultima_atualizacao
+    falhas = 0
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as sessao:
+        while True:
+            # A planilha de rotas é opcional: se ela falhar, as rotas atuais continuam valendo
+            # e a planilha de cadastro é atualizada do mesmo jeito
+            try:
+                await carregar_rotas_csv(sessao)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Erro ao atualizar a planilha de rotas (mantidas as rotas atuais): {e}")
+
+            try:
+                ultima_atualizacao = await carregar_dados_csv(sessao)
+                falhas = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                falhas += 1
+                ultima_atualizacao = {"status": "erro", "erro": str(e), "falhas": falhas}
+                print(f"❌ Erro ao atualizar a planilha: {e}")
 
-# 🔹 Função para monitorar a conexão com a internet e alertar os administradores
-def monitorar_conexao(context=None):
+            if falhas:
+                espera = min(BACKOFF_MAXIMO_ATUALIZACAO, BACKOFF_INICIAL_ATUALIZACAO * 2 ** (falhas - 1))
+            else:
+                espera = INTERVALO_ATUALIZACAO
+            espera = max(1.0, espera + random.uniform(-JITTER_ATUALIZACAO, JITTER_ATUALIZACAO))
+            await asyncio.sleep(espera)
+
+# 🔹 Monitoramento assíncrono da conexão com o Telegram
+INTERVALO_MONITORAMENTO = float(os.getenv("INTERVALO_MONITORAMENTO", "30"))  # segundos
+TIMEOUT_MONITORAMENTO = float(os.getenv("TIMEOUT_MONITORAMENTO", "10"))  # segundos
+FALHAS_PARA_QUEDA = int(os.getenv("FALHAS_PARA_QUEDA", "3"))
+SUCESSOS_PARA_RETORNO = int(os.getenv("SUCESSOS_PARA_RETORNO", "2"))
+ALVO_MONITORAMENTO = os.getenv("ALVO_MONITORAMENTO")  # Opcional: URL testada no lugar do getMe
+
+class MonitorConexao:
     """
-    Verifica a conexão com a internet a cada 60 segundos.
-    Se a conexão cair, alerta os administradores no Telegram.
+    Sonda periodicamente a API do Telegram e mede a latência de ida e volta.
+    Usa histerese (FALHAS_PARA_QUEDA / SUCESSOS_PARA_RETORNO) para não oscilar: durante a
+    queda, a fila de envios fica retida e é liberada na volta, junto com os alertas da
+    caixa de saída que falharam antes da queda ser declarada; um aviso de queda e um de
+    retorno são enviados por queda, nunca um por sonda.
     """
-    while True:
+
+    def __init__(self, bot, sonda):
+        self.bot = bot
+        self.sonda = sonda
+        self.latencias = Histograma()
+        self.conectado = True
+        self.falhas_seguidas = 0
+        self.sucessos_seguidos = 0
+        self.caiu_em = None
+        self.quedas = 0
+        self.avisos = set()
+
+    async def verificar(self):
+        inicio = time.perf_counter()
         try:
-            if not internet_disponivel():
-                print("❌ Conexão perdida! Enviando alerta...")
-                exibir_alerta_conexao(context)
-            else:
-                print("✅ Conexão com a internet verificada. Status: Conectado.")
+            await asyncio.wait_for(self.sonda(), TIMEOUT_MONITORAMENTO)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"❌ Erro no monitoramento da conexão: {e}")
-        time.sleep(60)  # Verifica a cada 60 segundos
+            self.falhas_seguidas += 1
+            self.sucessos_seguidos = 0
+            if self.conectado:
+                print(f"❌ Falha na verificação de conexão ({self.falhas_seguidas}/{FALHAS_PARA_QUEDA}): {e!r}")
+                if self.falhas_seguidas >= FALHAS_PARA_QUEDA:
+                    self._registrar_queda()
+            return False
+
+        self.latencias.observar((time.perf_counter() - inicio) * 1000)
+        self.sucessos_seguidos += 1
+        self.falhas_seguidas = 0
+        if not self.conectado and self.sucessos_seguidos >= SUCESSOS_PARA_RETORNO:
+            self._registrar_retorno()
+        return True
+
+    def _avisar(self, corotina):
+        # Os avisos só terminam quando a fila for liberada; não podem travar o monitor
+        tarefa = asyncio.create_task(corotina)
+        self.avisos.add(tarefa)
+        tarefa.add_done_callback(self.avisos.discard)
+
+    def _registrar_queda(self):
+        self.conectado = False
+        self.caiu_em = time.time()
+        self.quedas += 1
+        despachante.reter()
+        print("❌ Conexão perdida! Envios para administradores retidos até a reconexão.")
+        self._avisar(exibir_alerta_conexao(self.bot, self.caiu_em))
+
+    def _registrar_retorno(self):
+        duracao = time.time() - self.caiu_em
+        retidos = len(despachante)
+        self.conectado = True
+        self.caiu_em = None
+        despachante.liberar()
+        self._avisar(exibir_retorno_conexao(self.bot, duracao, retidos))
+        # A queda só é declarada após FALHAS_PARA_QUEDA sondas: alertas que desistiram antes disso
+        # estão na caixa de saída e saem agora, sem esperar o próximo reenvio periódico
+        self._avisar(reenviar_falhas(self.bot))
+
+    async def executar(self):
+        while True:
+            await self.verificar()
+            await asyncio.sleep(INTERVALO_MONITORAMENTO)
+
+def criar_sonda(bot):
+    """ Sonda padrão: getMe na própria API do Telegram; ALVO_MONITORAMENTO troca por um GET simples """
+    if not ALVO_MONITORAMENTO:
+        return bot.get_me
+
+    sessao = None
+
+    async def sonda_http():
+        nonlocal sessao
+        if sessao is None or sessao.closed:
+            sessao = aiohttp.ClientSession()
+        async with sessao.get(ALVO_MONITORAMENTO) as response:
+            response.raise_for_status()
+
+    return sonda_http
+
+monitor_conexao = None
+
+# 🔹 Exposição das métricas: endpoint /metrics (Prometheus) e comando /status
+METRICAS_HOST = os.getenv("METRICAS_HOST", "0.0.0.0")
+METRICAS_PORTA = os.getenv("METRICAS_PORTA")  # No modo polling, o /metrics só sobe se esta porta for definida
+
+def medidores_atuais():
+    """ Valores instantâneos lidos dos outros componentes no momento da coleta """
+    yield "guardiao_cadastros", "gauge", {}, len(indice_escolas)
+    yield "guardiao_planilha_pronta", "gauge", {}, int(planilha_pronta.is_set())
+    yield "guardiao_incidentes_ativos", "gauge", {}, len(gerenciador_incidentes.ativos)
+    yield "guardiao_tempo_ativo_segundos", "gauge", {}, round(time.time() - metricas.iniciado_em, 1)
+    yield "guardiao_caixa_saida_pendentes", "gauge", {}, len(caixa_saida.pendentes)
+    yield "guardiao_unidades_com_posicao", "gauge", {}, len(unidades_resposta.unidades)
+    yield "guardiao_historico_eventos_total", "counter", {}, historico_incidentes.eventos_gravados
+    yield "guardiao_desconhecidos_rastreados", "gauge", {}, len(controle_desconhecidos.chats)
+    yield "guardiao_desconhecidos_respostas_suprimidas_total", "counter", {}, controle_desconhecidos.respostas_suprimidas
+    yield "guardiao_caixa_saida_fsyncs_total", "counter", {}, caixa_saida.fsyncs
+    yield "guardiao_caixa_saida_registros_total", "counter", {}, caixa_saida.registros_gravados
+    for classe, valores in despachante.metricas().items():
+        yield "guardiao_fila_profundidade", "gauge", {"classe": classe}, valores["profundidade"]
+        yield "guardiao_fila_descartados_total", "counter", {"classe": classe}, valores["descartados"]
+        yield "guardiao_fila_espera_maxima_segundos", "gauge", {"classe": classe}, round(valores["espera_maxima"], 4)
+    if monitor_conexao is not None:
+        yield "guardiao_conectado", "gauge", {}, int(monitor_conexao.conectado)
+        yield "guardiao_quedas_total", "counter", {}, monitor_conexao.quedas
+        latencias = monitor_conexao.latencias
+        yield "guardiao_sonda_latencia_p95_ms", "gauge", {}, latencias.percentil(95)
+        yield "guardiao_sonda_total", "counter", {}, latencias.total
+    if ultima_atualizacao:
+        yield "guardiao_planilha_bytes_ultima_atualizacao", "gauge", {}, ultima_atualizacao.get("bytes", 0)
+        yield "guardiao_planilha_linhas_alteradas_ultima_atualizacao", "gauge", {}, ultima_atualizacao.get("linhas_alteradas", 0)
+
+async def exibir_metricas(request):
+    return web.Response(text=metricas.exportar(medidores_atuais()), content_type="text/plain", charset="utf-8")
+
+async def iniciar_servidor_metricas(host, porta):
+    servidor = web.Application()
+    servidor.router.add_get("/metrics", exibir_metricas)
+    runner = web.AppRunner(servidor, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, porta).start()
+    print(f"📈 Métricas disponíveis em http://{host}:{porta}/metrics")
+    return runner
+
+def formatar_ms(valor):
+    return "—" if valor == float("inf") else f"{valor:g} ms"
+
+async def status(update: Update, context: CallbackContext):
+    """ Resumo operacional para administradores """
+    if str(update.message.chat_id) not in ADMIN_CHAT_IDS:
+        return
+
+    ponta_a_ponta = metricas.agregado("guardiao_alerta_ponta_a_ponta_ms")
+    alertas = metricas.soma("guardiao_alertas_total")
+    falhas = metricas.soma("guardiao_envios_total", resultado="erro")
+    fila = despachante.metricas()
+    conexao = "—"
+    if monitor_conexao is not None:
+        conexao = "✅ conectado" if monitor_conexao.conectado else "❌ sem conexão"
+        conexao += f" (sonda p95: {formatar_ms(monitor_conexao.latencias.percentil(95))})"
 
-# 🔹 Função para iniciar o bot no servidor
-async def iniciar_bot():
+    mensagem = (
+        "📊 *Status do Guardião Escolar*\n\n"
+        f"⏱️ *Ativo há*: {int((time.time() - metricas.iniciado_em) // 60)} min\n"
+        f"📋 *Cadastros*: {len(indice_escolas)} ({'pronta' if planilha_pronta.is_set() else 'carregando'}, "
+        f"última atualização: {escapar_markdown(ultima_atualizacao.get('status', '—'))})\n"
+        f"🌐 *Conexão*: {conexao}\n"
+        f"🚨 *Alertas*: {alertas} | *Incidentes ativos*: {len(gerenciador_incidentes.ativos)}\n"
+        f"📨 *Ponta a ponta*: p50 {formatar_ms(ponta_a_ponta.percentil(50))}, p95 {formatar_ms(ponta_a_ponta.percentil(95))}\n"
+        f"❌ *Tentativas de envio com erro*: {falhas}\n"
+        f"💾 *Alertas pendentes na caixa de saída*: {len(caixa_saida.pendentes)}\n"
+        f"📥 *Fila*: " + ", ".join(f"{classe} {valores['profundidade']}" for classe, valores in fila.items())
+    )
+    await update.message.reply_text(mensagem, parse_mode='Markdown')
+
+# 🔹 Consulta ao histórico de incidentes: /historico [escola] [período] [csv]
+LIMITE_LINHAS_HISTORICO = 20
+
+def interpretar_periodo(texto, agora=None):
     """
-    Inicializa o bot do Telegram, configura os handlers e inicia threads essenciais.
+    Converte 'hoje', 'ontem', '24h', '7d', 'dd/mm', 'dd/mm/aaaa' ou 'dd/mm/aaaa-dd/mm/aaaa'
+    em (início, fim) no horário local. Retorna None se o texto não for um período.
     """
-    print("🚀 Iniciando Guardião Escolar...")
+    agora = time.time() if agora is None else agora
+    texto = texto.strip().lower()
+
+    def meia_noite(instante, dias=0):
+        data = time.localtime(instante)
+        return time.mktime((data.tm_year, data.tm_mon, data.tm_mday + dias, 0, 0, 0, 0, 0, -1))
+
+    def dia(data):
+        partes = data.split("/")
+        if len(partes) == 2:
+            partes.append(str(time.localtime(agora).tm_year))
+        try:
+            return meia_noite(time.mktime(time.strptime("/".join(partes), "%d/%m/%Y")))
+        except ValueError:
+            return None
+
+    if texto == "hoje":
+        return meia_noite(agora), agora
+    if texto == "ontem":
+        return meia_noite(agora, -1), meia_noite(agora)
+    relativo = re.fullmatch(r"(\d+)([hd])", texto)
+    if relativo:
+        return agora - int(relativo.group(1)) * (3600 if relativo.group(2) == "h" else 86400), agora
+    if "-" in texto:
+        inicio, _, fim = texto.partition("-")
+        inicio, fim = dia(inicio), dia(fim)
+        if inicio is None or fim is None:
+            return None
+        return inicio, meia_noite(fim, 1)
+    inicio = dia(texto)
+    return None if inicio is None else (inicio, meia_noite(inicio, 1))
+
+def renderizar_linha_historico(incidente):
+    if incidente["encerrado_em"]:
+        situacao = f"encerrado por {incidente['encerrado_por']}"
+    elif incidente["reconhecido_em"]:
+        situacao = f"ciente: {incidente['reconhecido_por']}"
+    else:
+        situacao = "em andamento"
+    return (
+        f"🔹 {time.strftime('%d/%m/%y %H:%M', time.localtime(incidente['aberto_em']))} — "
+        f"*{escapar_markdown((incidente['tipo'] or '').upper())}* — {escapar_markdown(incidente['escola'])}\n"
+        f"      {escapar_markdown(situacao)}, {incidente['atualizacoes']} atualização(ões)"
+    )
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def historico(update: Update, context: CallbackContext):
+    """ Incidentes anteriores por escola e/ou período (apenas administradores); 'csv' no fim exporta o relatório """
+    if str(update.message.chat_id) not in ADMIN_CHAT_IDS:
+        return
+
+    argumentos = list(context.args or [])
+    exportar = bool(argumentos) and argumentos[-1].lower() == "csv"
+    if exportar:
+        argumentos.pop()
+    inicio = fim = None
+    if argumentos:
+        periodo = interpretar_periodo(argumentos[-1])
+        if periodo is not None:
+            inicio, fim = periodo
+            argumentos.pop()
+    escola = normalizar_chave(" ".join(argumentos)) or None
+
+    # Eventos ainda no lote em memória entram na consulta
+    if historico_incidentes.gravacao is not None and not historico_incidentes.gravacao.done():
+        await asyncio.shield(historico_incidentes.gravacao)
+
+    if exportar:
+        conteudo = await asyncio.to_thread(historico_incidentes.exportar_csv, escola, inicio, fim)
+        await update.message.reply_document(
+            document=conteudo, filename=f"historico_incidentes_{time.strftime('%Y%m%d_%H%M')}.csv",
+            caption="📄 Histórico de incidentes",
+        )
+        return
+
+    total, incidentes = await asyncio.to_thread(lambda: (
+        historico_incidentes.contar(escola, inicio, fim),
+        list(historico_incidentes.consultar(escola, inicio, fim, limite=LIMITE_LINHAS_HISTORICO)),
+    ))
+    if not incidentes:
+        await update.message.reply_text("📭 Nenhum incidente encontrado para esse filtro.")
+        return
+    mensagem = f"🗂️ *Histórico de incidentes* ({total} encontrado(s)"
+    if total > len(incidentes):
+        mensagem += f", {len(incidentes)} mais recentes"
+    mensagem += ")\n\n" + "\n".join(renderizar_linha_historico(incidente) for incidente in incidentes)
+    if total > len(incidentes):
+        mensagem += "\n\nAcrescente `csv` ao comando para exportar todos."
+    await update.message.reply_text(mensagem, parse_mode='Markdown')
+
+# 🔹 Tarefas de segundo plano executadas no event loop do bot
+tarefas_em_segundo_plano = []
+servidores_em_segundo_plano = []
+
+async def iniciar_tarefas(application):
+    global monitor_conexao
+    monitor_conexao = MonitorConexao(application.bot, criar_sonda(application.bot))
+    pendentes = caixa_saida.abrir()
+    # Incidentes em memória não sobrevivem a um reinício: fecha no histórico os que ficaram abertos
+    try:
+        encerrados = await asyncio.to_thread(historico_incidentes.encerrar_pendentes, "reinício do bot")
+        if encerrados:
+            print(f"🔒 {encerrados} incidente(s) abertos antes do reinício encerrados no histórico")
+    except sqlite3.Error as e:
+        print(f"❌ Erro ao encerrar incidentes pendentes no histórico: {e}")
+    if pendentes:
+        tarefas_em_segundo_plano.append(asyncio.create_task(reenviar_pendentes(application.bot, pendentes)))
+    tarefas_em_segundo_plano.append(asyncio.create_task(atualizar_planilha_periodicamente()))
+    tarefas_em_segundo_plano.append(asyncio.create_task(monitor_conexao.executar()))
+    tarefas_em_segundo_plano.append(asyncio.create_task(enviar_resumos_desconhecidos(application.bot)))
+    tarefas_em_segundo_plano.append(asyncio.create_task(varrer_incidentes()))
+    tarefas_em_segundo_plano.append(asyncio.create_task(reenviar_falhas_periodicamente(application.bot)))
+    if METRICAS_PORTA:
+        servidores_em_segundo_plano.append(await iniciar_servidor_metricas(METRICAS_HOST, int(METRICAS_PORTA)))
+
+async def encerrar_tarefas(application):
+    await despachante.parar()
+    for tarefa in tarefas_em_segundo_plano:
+        tarefa.cancel()
+    await asyncio.gather(*tarefas_em_segundo_plano, return_exceptions=True)
+    tarefas_em_segundo_plano.clear()
+    if caixa_saida.gravacao is not None:
+        await caixa_saida.gravacao
+    caixa_saida.fechar()
+    if historico_incidentes.gravacao is not None:
+        await historico_incidentes.gravacao
+    for runner in servidores_em_segundo_plano:
+        await runner.cleanup()
+    servidores_em_segundo_plano.clear()
+
+# 🔹 Monta a aplicação do Telegram com todos os handlers
+def criar_aplicacao(token=TELEGRAM_TOKEN, base_url=None):
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(True)  # Um alerta em andamento não segura as próximas mensagens
+        .post_init(iniciar_tarefas)
+        .post_shutdown(encerrar_tarefas)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
+    # Edições chegam como edited_message (update.message vazio): só a localização em tempo real as usa
+    novas = filters.UpdateType.MESSAGE
 
     # ✅ Adicionando handlers para comandos de emergência
-    application.add_handler(CommandHandler('bomba', bomba))
-    application.add_handler(CommandHandler('ameaca', ameaca))
-    application.add_handler(CommandHandler('refem', refem))
-    application.add_handler(CommandHandler('agressor', agressor))
-    application.add_handler(CommandHandler('homicidio', homicidio))
-    application.add_handler(CommandHandler('teste', teste))
+    application.add_handler(CommandHandler('bomba', bomba, filters=novas))
+    application.add_handler(CommandHandler('ameaca', ameaca, filters=novas))
+    application.add_handler(CommandHandler('refem', refem, filters=novas))
+    application.add_handler(CommandHandler('agressor', agressor, filters=novas))
+    application.add_handler(CommandHandler('homicidio', homicidio, filters=novas))
+    application.add_handler(CommandHandler('teste', teste, filters=novas))
 
     # ✅ Handler para cadastro
-    application.add_handler(CommandHandler('cadastro', cadastro))
+    application.add_handler(CommandHandler('cadastro', cadastro, filters=novas))
 
     # ✅ Handlers para comandos básicos
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('ajuda', ajuda))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, mensagem_recebida))
+    application.add_handler(CommandHandler('start', start, filters=novas))
+    application.add_handler(CommandHandler('ajuda', ajuda, filters=novas))
+    application.add_handler(CommandHandler('status', status, filters=novas))
+    application.add_handler(CommandHandler('historico', historico, filters=novas))
+    application.add_handler(MessageHandler(novas & filters.TEXT & ~filters.COMMAND, mensagem_recebida))
+    application.add_handler(MessageHandler(filters.LOCATION, localizacao_recebida))
+    application.add_handler(MessageHandler(
+        novas & (
+            filters.PHOTO | filters.VOICE | filters.AUDIO | filters.VIDEO | filters.VIDEO_NOTE | filters.Document.ALL
+        ),
+        midia_recebida,
+    ))
+
+    # ✅ Botões dos alertas (ciente / encerrar incidente)
+    application.add_handler(CallbackQueryHandler(responder_incidente, pattern=r"^incidente:"))
+    return application
+
+# 🔹 Recebimento de updates via webhook (servidor aiohttp local)
+async def iniciar_servidor_webhook(application, host, porta, caminho, segredo):
+    """
+    Sobe o servidor HTTP que recebe os updates do Telegram.
+    Confere o token secreto, responde 200 imediatamente e entrega o update
+    à fila da aplicação, onde os handlers o processam de forma assíncrona.
+    """
+
+    async def receber_update(request):
+        recebido = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(recebido, segredo):
+            return web.Response(status=403)
+        try:
+            dados = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(dados, application.bot))
+        return web.Response()
+
+    servidor = web.Application()
+    servidor.router.add_post(caminho, receber_update)
+    servidor.router.add_get("/metrics", exibir_metricas)
+    runner = web.AppRunner(servidor, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, porta).start()
+    return runner
+
+async def executar_webhook(application):
+    """ Ciclo de vida completo do bot no modo webhook """
+    await application.initialize()
+    await iniciar_tarefas(application)
+    runner = await iniciar_servidor_webhook(application, WEBHOOK_HOST, WEBHOOK_PORTA, WEBHOOK_CAMINHO, WEBHOOK_SEGREDO)
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_CAMINHO,
+            secret_token=WEBHOOK_SEGREDO,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        print(f"✅ Webhook ativo em {WEBHOOK_HOST}:{WEBHOOK_PORTA}{WEBHOOK_CAMINHO}")
+        await asyncio.Event().wait()  # Roda até o processo ser interrompido
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await encerrar_tarefas(application)
+        await application.shutdown()
 
-    # ✅ Iniciar a atualização da planilha em segundo plano
-    threading.Thread(target=atualizar_planilha_periodicamente, daemon=True).start()
+# 🔹 Função para iniciar o bot no servidor
+def iniciar_bot():
+    """
+    Inicializa o bot do Telegram a partir do snapshot local e configura os handlers.
+    As tarefas em segundo plano (planilha, monitor de conexão, reenvios, resumos) rodam
+    como tarefas asyncio no mesmo loop, criadas em iniciar_tarefas (post_init).
+    O modo de recebimento (polling ou webhook) é escolhido por MODO_RECEBIMENTO.
+    """
+    print("🚀 Iniciando Guardião Escolar...")
 
-    # Iniciar o monitoramento da conexão usando application.bot
-    threading.Thread(target=monitorar_conexao, args=(application.bot,), daemon=True).start()
+    # Snapshot local primeiro: o bot já começa atendendo com a última planilha conhecida
+    carregar_snapshot()
 
-    print("✅ Guardião Escolar está rodando! Aguardando mensagens...")
-    
-    # Iniciar o bot
-    await application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application = criar_aplicacao(base_url=TELEGRAM_API_URL)
+
+    print(f"✅ Guardião Escolar está rodando ({MODO_RECEBIMENTO})! Aguardando mensagens...")
+
+    if MODO_RECEBIMENTO == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ MODO_RECEBIMENTO=webhook exige a variável WEBHOOK_URL")
+        try:
+            asyncio.run(executar_webhook(application))
+        except KeyboardInterrupt:
+            pass
+    else:
+        # Iniciar o bot (a atualização da planilha é iniciada no post_init, dentro do mesmo loop)
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.create_task(iniciar_bot())
-    loop.run_forever()
\ No newline at end of file
+    iniciar_bot()